@@ -0,0 +1,117 @@
+"""
+Build a compact WordPiece vocab from the training split and point the
+params YAML files at it.
+
+The vocab holds the special tokens, every character seen (word-initial and
+"##" continuation, so nothing maps to [UNK]) and each whole word seen at
+least --min_frequency times, most frequent first. vocab_size in the YAML
+files is set to the vocab length rounded up to --pad_to_multiple_of, and
+their vocab_file entries to the new file.
+"""
+import argparse
+import collections
+import os
+import re
+
+from wordpiece import MAX_INPUT_CHARS_PER_WORD, basic_tokenize
+
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+# the uncommented "vocab_size: <n>" and "vocab_file: <path>" lines, keeping their indentation
+VOCAB_SIZE_LINE = re.compile(r"^(\s*vocab_size:\s*)\d+.*$", re.MULTILINE)
+VOCAB_FILE_LINE = re.compile(r"""^(\s*vocab_file:\s*)(?:"[^"]*"|'[^']*'|[^\s#]+)""", re.MULTILINE)
+
+
+def read_input_files(metadata_files, input_files_prefix=""):
+    input_files = []
+    for metadata_file in metadata_files:
+        with open(metadata_file, 'r') as f:
+            input_files.extend(os.path.join(input_files_prefix, line.strip()) for line in f if line.strip())
+    return input_files
+
+
+def count_words(input_files, do_lower_case):
+    counts = collections.Counter()
+    for input_file in input_files:
+        with open(input_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                counts.update(basic_tokenize(line, do_lower_case))
+    return counts
+
+
+def build_vocab(counts, min_frequency=2, max_vocab_size=None):
+    """Special tokens, then characters, then frequent whole words; returns the token list."""
+    chars = sorted({char for word in counts for char in word})
+    vocab = SPECIAL_TOKENS + chars + ["##" + char for char in chars]
+    seen = set(vocab)
+    words = sorted(
+        (word for word, count in counts.items()
+         if count >= min_frequency and word not in seen and len(word) <= MAX_INPUT_CHARS_PER_WORD),
+        key=lambda word: (-counts[word], word),
+    )
+    if max_vocab_size is not None:
+        words = words[:max(0, max_vocab_size - len(vocab))]
+    return vocab + words
+
+
+def padded_vocab_size(vocab, multiple):
+    return -(-len(vocab) // multiple) * multiple
+
+
+def patch_params(params_file, outfile, vocab_size, vocab_file):
+    with open(params_file, 'r') as f:
+        text = f.read()
+    text, n_sizes = VOCAB_SIZE_LINE.subn(rf"\g<1>{vocab_size} # set by build_vocab.py", text)
+    text = VOCAB_FILE_LINE.sub(lambda match: f'{match.group(1)}"{vocab_file}"', text)
+    if n_sizes == 0:
+        raise ValueError(f"{params_file} has no vocab_size entry to patch")
+    with open(outfile, 'w') as f:
+        f.write(text)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--metadata_files', nargs='+', required=True,
+                        help="meta.txt file(s) listing the training chunk files")
+    parser.add_argument('--input_files_prefix', default="", help="prefix for relative paths in the meta files")
+    parser.add_argument('--output_file', required=True, help="vocab file to write")
+    parser.add_argument('--min_frequency', type=int, default=2,
+                        help="minimum count for a whole word to get its own token")
+    parser.add_argument('--max_vocab_size', type=int, default=None,
+                        help="cap on the number of tokens, keeping the most frequent words")
+    parser.add_argument('--do_lower_case', action='store_true',
+                        help="lower case before counting; must match do_lower in the params files")
+    parser.add_argument('--params_files', nargs='*', default=[],
+                        help="params YAML files whose vocab_size and vocab_file are patched")
+    parser.add_argument('--params_output_dir', default=None,
+                        help="write patched params files here instead of in place")
+    parser.add_argument('--pad_to_multiple_of', type=int, default=8,
+                        help="round vocab_size up to a multiple of this")
+    args = parser.parse_args()
+
+    counts = count_words(read_input_files(args.metadata_files, args.input_files_prefix), args.do_lower_case)
+    vocab = build_vocab(counts, args.min_frequency, args.max_vocab_size)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_file)), exist_ok=True)
+    with open(args.output_file, 'w', encoding='utf-8') as f:
+        for token in vocab:
+            f.write(token + "\n")
+
+    in_vocab = set(vocab)
+    total = sum(counts.values())
+    covered = sum(count for word, count in counts.items() if word in in_vocab)
+    print(f"[INFO] {len(counts)} distinct words, {len(vocab)} tokens written to {os.path.abspath(args.output_file)}; "
+          f"{covered / total if total else 0.:.2%} of word occurrences are a single token")
+
+    vocab_size = padded_vocab_size(vocab, args.pad_to_multiple_of)
+    vocab_file = os.path.abspath(args.output_file)
+    for params_file in args.params_files:
+        outfile = params_file
+        if args.params_output_dir:
+            os.makedirs(args.params_output_dir, exist_ok=True)
+            outfile = os.path.join(args.params_output_dir, os.path.basename(params_file))
+        patch_params(params_file, outfile, vocab_size, vocab_file)
+        print(f"[INFO] Set vocab_size: {vocab_size} and vocab_file in {outfile}")
+
+
+if __name__ == "__main__":
+    main()
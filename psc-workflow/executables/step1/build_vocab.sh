@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
+
+# TODO: This substep will run on CPU (Neocortex or Bridges-2)
+#compact vocab from the TRAIN split; points the pretraining and regression params at it
+python3 build_vocab.py --metadata_files ${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/pretraining/train/meta.txt --output_file ${ENTRY_LOCATION}/tokenizer/materials_string_OCELOT_compact.txt --min_frequency 2 --params_files ${ENTRY_LOCATION}/roberta_params_OCELOT_MS.yaml ${ENTRY_LOCATION}/regression_params.yaml
+
+# Pegasus stages the job's declared output out of the working directory; the CSV jobs
+# and the params keep using the vocab under ${ENTRY_LOCATION}/tokenizer
+cp ${ENTRY_LOCATION}/tokenizer/materials_string_OCELOT_compact.txt materials_string_OCELOT_compact.txt
@@ -17,25 +17,47 @@ Preprocessed CSV data generator for BERT pretraining from
 raw text documents.
 """
 import argparse
+import ast
+import collections
+import contextlib
+import copy
 import csv
+import functools
+import gc
+import hashlib
+import inspect
 import json
 import logging
+import math
+import multiprocessing
 import os
-import subprocess as sp
+import queue
+import random
+import resource
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
 
 MODELZOO_PATH = os.getenv(key='MODELZOO_PATH', default='/ocean/neocortex/cerebras/modelzoo')
 sys.path.append(MODELZOO_PATH)
 
 from modelzoo.common.input.utils import check_and_create_output_dirs
+from modelzoo.transformers.data_processing import mlm_only_processor
 from modelzoo.transformers.data_processing.mlm_only_processor import (
     data_generator,
 )
 from modelzoo.transformers.data_processing.utils import (
-    count_total_documents,
     get_output_type_shapes,
 )
 
+from token_shards import TokenIdEncoder, TokenShardWriter, write_token_index
+import wordpiece
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -192,10 +214,469 @@ def parse_args():
     parser.add_argument(
         "--seed", type=int, default=0, help="random seed. Defaults to 0.",
     )
+    parser.add_argument(
+        "--splits",
+        type=str,
+        nargs='+',
+        default=None,
+        help="names of several splits to generate in one run, e.g. "
+             "'train val test'. Every occurrence of {split} in "
+             "--metadata_files, --input_files_prefix, --output_dir and "
+             "--name is replaced by the split name. The vocab and spaCy "
+             "model are loaded once for all splits.",
+    )
+    parser.add_argument(
+        "--write_queue_size",
+        type=int,
+        default=0,
+        help="number of row batches that may wait for a background writer "
+             "thread, so tokenization overlaps with disk writes. "
+             "0 writes synchronously. Defaults to 0.",
+    )
+    parser.add_argument(
+        "--write_batch_size",
+        type=int,
+        default=1024,
+        help="rows per output file gathered into one writerows call by the "
+             "background writer. Defaults to 1024.",
+    )
+    parser.add_argument(
+        "--write_buffer_size",
+        type=int,
+        default=-1,
+        help="buffer size in bytes of each output file; -1 uses the system "
+             "default. Defaults to -1.",
+    )
+    parser.add_argument(
+        "--pack_sequences",
+        action="store_true",
+        help="bin-pack several whole examples into each max_seq_length "
+             "sequence, joined by --document_separator_token, and write "
+             "their lengths to <name>-<i>.seg. Requires --output_format "
+             "tokens and cannot be combined with "
+             "--allow_cross_document_examples.",
+    )
+    parser.add_argument(
+        "--pack_buffer_size",
+        type=int,
+        default=10000,
+        help="number of examples bin-packed together by --pack_sequences. "
+             "Defaults to 10000.",
+    )
+    parser.add_argument(
+        "--fast_tokenizer",
+        action="store_true",
+        help="tokenize with the batched trie tokenizer in wordpiece.py "
+             "instead of modelzoo's FullTokenizer; the tokens are the same.",
+    )
+    parser.add_argument(
+        "--token_cache",
+        type=str,
+        default=None,
+        help="SQLite file caching the tokenized documents of each input "
+             "file, keyed by its contents, the vocab file and do_lower_case. "
+             "Reruns with other sequence or masking settings only redo "
+             "example assembly. Defaults to no cache.",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["csv", "tokens"],
+        default="csv",
+        help="'csv' writes token strings for BertCSVDynamicMaskDataProcessor; "
+             "'tokens' writes binary token-id shards (<name>-<i>.bin/.idx) "
+             "for BertTokenShardDataProcessor. Defaults to 'csv'.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of processes to split the input files across. Each "
+             "worker writes its own <name>-shard<k>-<i>.csv files, with a seed "
+             "derived from --seed and k. Defaults to 1.",
+    )
 
     return parser.parse_args()
 
 
+class PipelinedCSVWriter:
+    """
+    Write rows to several csv writers from a background thread.
+
+    Rows are gathered into batches of batch_size per writer and handed to
+    the thread through a queue holding at most queue_size batches, so the
+    generator keeps tokenizing while the thread is in writerows. The time
+    the producer spends blocked on a full queue and the time the writer
+    thread spends blocked on an empty one are measured for the summary.
+    """
+
+    def __init__(self, writers, queue_size, batch_size):
+        self.writers = writers
+        self.batch_size = batch_size
+        self.batches = [[] for _ in writers]
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.producer_blocked = 0.
+        self.writer_blocked = 0.
+        self.error = None
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def writerow(self, index, row):
+        batch = self.batches[index]
+        batch.append(row)
+        if len(batch) >= self.batch_size:
+            self._put((index, batch))
+            self.batches[index] = []
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put(item)
+        self.producer_blocked += time.perf_counter() - start
+
+    def _run(self):
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.writer_blocked += time.perf_counter() - start
+            if item is None:
+                self.queue.task_done()
+                return
+            if self.error is None:
+                index, rows = item
+                try:
+                    self.writers[index].writerows(rows)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def flush(self):
+        """Hand over the partial batches and wait until everything queued is written."""
+        for index, batch in enumerate(self.batches):
+            if batch:
+                self._put((index, batch))
+                self.batches[index] = []
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        self._put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        elapsed = time.perf_counter() - self.start_time
+        logging.info(
+            f"Pipelined writer: {elapsed:.1f}s total, producer blocked on "
+            f"writer {self.producer_blocked:.1f}s, writer blocked on "
+            f"producer {self.writer_blocked:.1f}s, writer busy "
+            f"{elapsed - self.writer_blocked:.1f}s"
+        )
+
+
+class DatasetProfile:
+    """
+    Counts collected while the CSVs are written: rows per output file,
+    input documents (None if they could not be counted) and a histogram of
+    example lengths in tokens. Profiles from several workers are combined
+    with merge().
+    """
+
+    def __init__(self):
+        self.rows_per_file = {}
+        self.n_docs = 0
+        self.token_lengths = collections.Counter()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.max_seq_length = None
+        # set when --pack_sequences is used
+        self.unpacked_examples = 0
+        self.unpacked_tokens = 0
+
+    def add_example(self, file_name, features):
+        self.rows_per_file[file_name] += 1
+        # str features are the repr of a token list, as SequencePacker reads them
+        tokens = ast.literal_eval(features) if isinstance(features, str) else features
+        self.token_lengths[sum(1 for token in tokens if token != "[PAD]")] += 1
+
+    def merge(self, other):
+        self.rows_per_file.update(other.rows_per_file)
+        if self.n_docs is None or other.n_docs is None:
+            self.n_docs = None
+        else:
+            self.n_docs += other.n_docs
+        self.token_lengths.update(other.token_lengths)
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        self.max_seq_length = self.max_seq_length or other.max_seq_length
+        self.unpacked_examples += other.unpacked_examples
+        self.unpacked_tokens += other.unpacked_tokens
+        return self
+
+    @property
+    def n_examples(self):
+        return sum(self.rows_per_file.values())
+
+    def percentile(self, q):
+        """Smallest length covering at least q percent of the examples."""
+        target = math.ceil(self.n_examples * q / 100)
+        seen = 0
+        for length in sorted(self.token_lengths):
+            seen += self.token_lengths[length]
+            if seen >= target:
+                return length
+        return 0
+
+    def padding_efficiency(self):
+        """Real tokens over padded tokens (examples x max_seq_length) of the output."""
+        real = sum(length * count for length, count in self.token_lengths.items())
+        padded = self.n_examples * self.max_seq_length
+        return real / padded if padded else 0.
+
+    def unpacked_padding_efficiency(self):
+        padded = self.unpacked_examples * self.max_seq_length
+        return self.unpacked_tokens / padded if padded else 0.
+
+    def recommended_max_sequence_length(self, multiple=64):
+        """Longest example rounded up to a multiple of `multiple`."""
+        longest = max(self.token_lengths, default=0)
+        return max(multiple, math.ceil(longest / multiple) * multiple)
+
+    def to_params(self):
+        params = {
+            "n_docs": "Unknown" if self.n_docs is None else self.n_docs,
+            "token_length_histogram": {
+                str(length): self.token_lengths[length]
+                for length in sorted(self.token_lengths)
+            },
+            "token_length_percentiles": {
+                f"p{q}": self.percentile(q) for q in (50, 90, 99, 100)
+            },
+            "recommended_max_sequence_length": self.recommended_max_sequence_length(),
+            "token_cache_hits": self.cache_hits,
+            "token_cache_misses": self.cache_misses,
+            "padding_efficiency": self.padding_efficiency(),
+        }
+        if self.unpacked_examples:
+            params["unpacked_padding_efficiency"] = self.unpacked_padding_efficiency()
+            params["documents_per_sequence"] = self.unpacked_examples / max(self.n_examples, 1)
+        return params
+
+
+class SequencePacker:
+    """
+    Best-fit-decreasing bin packing of examples into max_seq_length
+    sequences.
+
+    Examples are taken buffer_size at a time. Each keeps its tokens whole;
+    its own [CLS] and final [SEP] are dropped and the packed sequence is
+    [CLS] ex1 <sep> ex2 <sep> ... [SEP], with <sep> the
+    document_separator_token. pack() yields (features, segment_lengths), where
+    features has the same type as the input (a list repr or a list) and
+    segment_lengths gives the length of each example in the packed
+    sequence, the [CLS] and final [SEP] counting towards the first and last.
+    """
+
+    def __init__(self, max_seq_length, separator="[SEP]", buffer_size=10000, seed=None):
+        self.max_seq_length = max_seq_length
+        self.separator = separator
+        self.buffer_size = max(1, buffer_size)
+        self.rng = random.Random(seed)
+        self.examples = 0
+        self.tokens = 0
+
+    def _content(self, features):
+        tokens = ast.literal_eval(features) if isinstance(features, str) else list(features)
+        tokens = [token for token in tokens if token != "[PAD]"]
+        self.examples += 1
+        self.tokens += len(tokens)
+        if tokens and tokens[0] == "[CLS]":
+            tokens = tokens[1:]
+        if tokens and tokens[-1] == "[SEP]":
+            tokens = tokens[:-1]
+        return tokens[:self.max_seq_length - 2]
+
+    def _pack_buffer(self, contents):
+        # a sequence holding contents of total length n with k separators
+        # between them is n + k + 1 tokens long, so each content costs
+        # len + 1 against a capacity of max_seq_length - 1
+        capacity = self.max_seq_length - 1
+        bins = []
+        # remaining space -> indices of the bins with that much left
+        by_space = collections.defaultdict(list)
+        for content in sorted(contents, key=len, reverse=True):
+            size = len(content) + 1
+            for space in range(size, capacity + 1):
+                if by_space[space]:
+                    index = by_space[space].pop()
+                    break
+            else:
+                index = len(bins)
+                bins.append([])
+                space = capacity
+            bins[index].append(content)
+            by_space[space - size].append(index)
+        self.rng.shuffle(bins)
+        return bins
+
+    def pack(self, examples):
+        buffer = []
+        as_str = None
+        for features in examples:
+            if as_str is None:
+                as_str = isinstance(features, str)
+            buffer.append(self._content(features))
+            if len(buffer) >= self.buffer_size:
+                yield from self._emit(self._pack_buffer(buffer), as_str)
+                buffer = []
+        if buffer:
+            yield from self._emit(self._pack_buffer(buffer), as_str)
+
+    def _emit(self, bins, as_str):
+        for contents in bins:
+            tokens = ["[CLS]"]
+            segment_lengths = []
+            for i, content in enumerate(contents):
+                start = len(tokens)
+                if i:
+                    tokens.append(self.separator)
+                tokens.extend(content)
+                segment_lengths.append(len(tokens) - start)
+            tokens.append("[SEP]")
+            segment_lengths[0] += 1
+            segment_lengths[-1] += 1
+            yield (str(tokens) if as_str else tokens), segment_lengths
+
+
+class TokenizedDocumentCache:
+    """
+    Persistent cache of tokenized documents in a single SQLite file.
+
+    Entries are keyed by the SHA-256 of an input file's text and a
+    tokenizer key covering the vocab file contents, do_lower_case and the
+    document splitting options, so a changed chunk or vocab is a miss.
+
+    The file keeps SQLite's default rollback journal: it lives on /ocean,
+    which cannot hold the shared memory WAL needs, and only one process
+    writes it. With updates_path, as in the --num_workers workers, the
+    cache is opened read-only and new entries go to that file instead, for
+    the parent to fold in with merge_updates().
+    """
+
+    def __init__(self, path, tokenizer_key, updates_path=None):
+        self.path = path
+        self.tokenizer_key = tokenizer_key
+        self.hits = 0
+        self.misses = 0
+        if updates_path is None:
+            self.conn = self.updates = _open_document_table(path)
+        else:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=60)
+            self.updates = _open_document_table(updates_path)
+
+    def wrap(self, text_to_tokenized_documents):
+        """Cached version of text_to_tokenized_documents(data, ...)."""
+
+        @functools.wraps(text_to_tokenized_documents)
+        def cached(data, *args, **kwargs):
+            text_hash = hashlib.sha256(data.encode()).hexdigest()
+            row = self.conn.execute(
+                "SELECT documents FROM documents WHERE text_hash = ? AND tokenizer = ?",
+                (text_hash, self.tokenizer_key),
+            ).fetchone()
+            if row is not None:
+                self.hits += 1
+                return json.loads(zlib.decompress(row[0]))
+            self.misses += 1
+            documents = list(text_to_tokenized_documents(data, *args, **kwargs))
+            self.updates.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                (text_hash, self.tokenizer_key, zlib.compress(json.dumps(documents).encode())),
+            )
+            self.updates.commit()
+            return documents
+
+        return cached
+
+    def report(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.
+        logging.info(
+            f"Token cache {self.path}: {self.hits} hits, {self.misses} misses "
+            f"({ratio:.1%} hit rate)"
+        )
+
+    def close(self):
+        self.conn.close()
+        if self.updates is not self.conn:
+            self.updates.close()
+
+    @staticmethod
+    def merge_updates(path, updates_path, chunk_size=1000):
+        """Insert the entries of updates_path into the cache at path, one transaction per chunk."""
+        conn = _open_document_table(path)
+        updates = sqlite3.connect(updates_path)
+        try:
+            rows = updates.execute("SELECT text_hash, tokenizer, documents FROM documents")
+            while True:
+                chunk = rows.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)", chunk)
+        finally:
+            updates.close()
+            conn.close()
+
+
+def _open_document_table(path):
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS documents ("
+        "text_hash TEXT NOT NULL, tokenizer TEXT NOT NULL, documents BLOB NOT NULL, "
+        "PRIMARY KEY (text_hash, tokenizer))"
+    )
+    conn.commit()
+    return conn
+
+
+def tokenizer_key(vocab_file, do_lower_case, **options):
+    """Cache key for everything besides the text that decides the tokenized documents."""
+    with open(vocab_file, 'rb') as fin:
+        vocab_hash = hashlib.sha256(fin.read()).hexdigest()
+    return json.dumps(
+        dict(vocab=vocab_hash, do_lower_case=do_lower_case, **options), sort_keys=True
+    )
+
+
+def reset_peak_memory():
+    """Reset the peak RSS (VmHWM) of this process where Linux allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    except OSError:
+        pass
+
+
+def memory_usage_mb():
+    """Current and peak resident set size of this process, in MB."""
+    try:
+        usage = {}
+        with open("/proc/self/status", "r") as fin:
+            for line in fin:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    usage[key] = int(value.split()[0]) / 1024
+        return usage["VmRSS"], usage["VmHWM"]
+    except (OSError, KeyError):
+        # ru_maxrss is in kB on Linux and cannot be reset
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return None, peak
+
+
 def create_csv(
         metadata_files,
         vocab_file,
@@ -220,11 +701,22 @@ def create_csv(
         seed=None,
         spacy_model="en",
         input_files_prefix="",
+        write_queue_size=0,
+        write_batch_size=1024,
+        write_buffer_size=-1,
+        split_num=None,
+        output_format="csv",
+        token_cache=None,
+        token_cache_updates=None,
+        pack_sequences=False,
+        pack_buffer_size=10000,
+        shard=None,
 ):
     num_output_files = max(num_output_files, 1)
 
+    extension = ".bin" if output_format == "tokens" else ".csv"
     output_files = [
-        os.path.join(output_dir, f"{filename_prefix}-{fidx + 1}.csv")
+        os.path.join(output_dir, f"{filename_prefix}-{fidx + 1}{extension}")
         for fidx in range(num_output_files)
     ]
 
@@ -235,17 +727,36 @@ def create_csv(
     ## Names of keys of instance dictionary
     fieldnames = ["tokens"]
 
+    profile = DatasetProfile()
+    profile.max_seq_length = max_seq_length
+    file_names = [os.path.basename(output_file) for output_file in output_files]
+    for file_name in file_names:
+        profile.rows_per_file[file_name] = 0
+
     ## Create csv writers for each csv file
     writers = []
-    for output_file in output_files:
-        csvfile = open(output_file, 'w', newline='')
-        writer = csv.DictWriter(
-            csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL
-        )
-        writer.writeheader()
-        writers.append((writer, csvfile))
+    if output_format == "tokens":
+        ## token-id shards are their own writer and file
+        encode = TokenIdEncoder(vocab_file)
+        for output_file in output_files:
+            shard_writer = TokenShardWriter(
+                output_file[:-len(extension)],
+                encode.dtype,
+                buffering=write_buffer_size,
+                segments=pack_sequences,
+            )
+            writers.append((shard_writer, shard_writer))
+    else:
+        encode = None
+        for output_file in output_files:
+            csvfile = open(output_file, 'w', newline='', buffering=write_buffer_size)
+            writer = csv.DictWriter(
+                csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL
+            )
+            writer.writeheader()
+            writers.append((writer, csvfile))
 
-    def _data_generator():
+    def _data_generator(metadata_files, seed):
         return data_generator(
             metadata_files=metadata_files,
             vocab_file=vocab_file,
@@ -272,29 +783,311 @@ def create_csv(
             input_files_prefix=input_files_prefix,
         )
 
+    ## data_generator tokenizes each input file with text_to_tokenized_documents;
+    ## route that through the cache for this process and count the documents
+    cache = None
+    uncached = getattr(mlm_only_processor, "text_to_tokenized_documents", None)
+    if token_cache and uncached is None:
+        logging.warning(
+            "mlm_only_processor has no text_to_tokenized_documents; --token_cache is ignored"
+        )
+    elif token_cache:
+        cache = TokenizedDocumentCache(
+            token_cache,
+            tokenizer_key(
+                vocab_file,
+                do_lower_case,
+                multiple_docs_in_single_file=multiple_docs_in_single_file,
+                multiple_docs_separator=multiple_docs_separator,
+                single_sentence_per_line=single_sentence_per_line,
+                spacy_model=spacy_model,
+            ),
+            token_cache_updates,
+        )
+    if uncached is not None:
+        tokenize_documents = uncached if cache is None else cache.wrap(uncached)
+
+        @functools.wraps(uncached)
+        def counted(*args, **kwargs):
+            documents = list(tokenize_documents(*args, **kwargs))
+            profile.n_docs += len(documents)
+            return documents
+
+        mlm_only_processor.text_to_tokenized_documents = counted
+
+    if write_queue_size > 0:
+        pipelined_writer = PipelinedCSVWriter(
+            [writer for writer, _ in writers], write_queue_size, write_batch_size
+        )
+        write_row = pipelined_writer.writerow
+    else:
+        pipelined_writer = None
+
+        def write_row(index, row):
+            writers[index][0].writerow(row)
+
+    ## Read the input files split_num at a time, so the generator's buffers
+    ## only ever hold one group. Each group of each shard gets its own seed.
+    input_files = read_input_files(metadata_files)
+    # without the hook above, every input file is one document unless it
+    # holds several, which cannot be counted
+    if uncached is None:
+        profile.n_docs = None if multiple_docs_in_single_file else len(input_files)
+    if split_num and len(input_files) > split_num:
+        groups = [
+            input_files[start:start + split_num]
+            for start in range(0, len(input_files), split_num)
+        ]
+    else:
+        groups = [input_files]
+
     writer_index = 0
-    total_written = 0
 
-    for features in _data_generator():
-        ## write dictionary into csv
-        writers[writer_index][0].writerow({"tokens": features})
-        writer_index = (writer_index + 1) % len(writers)
-        total_written += 1
+    with tempfile.TemporaryDirectory() as meta_dir:
+        for group_index, group in enumerate(groups):
+            if len(groups) > 1:
+                group_metadata_file = os.path.join(meta_dir, f"meta_group{group_index}.txt")
+                with open(group_metadata_file, 'w') as fout:
+                    fout.writelines(f"{input_file}\n" for input_file in group)
+                group_metadata_files = [group_metadata_file]
+            else:
+                group_metadata_files = metadata_files
+            if len(groups) > 1 or shard is not None:
+                group_seed = derive_seed(seed, shard or 0, group_index)
+            else:
+                group_seed = seed
+
+            reset_peak_memory()
+            group_written = 0
+            examples = _data_generator(group_metadata_files, group_seed)
+            if pack_sequences:
+                packer = SequencePacker(
+                    max_seq_length, document_separator_token, pack_buffer_size, group_seed
+                )
+                examples = packer.pack(examples)
+            else:
+                examples = ((features, None) for features in examples)
+            for features, segment_lengths in examples:
+                ## write dictionary into csv
+                if encode is not None and segment_lengths is not None:
+                    write_row(writer_index, (encode(features), segment_lengths))
+                elif encode is not None:
+                    write_row(writer_index, encode(features))
+                else:
+                    write_row(writer_index, {"tokens": features})
+                profile.add_example(file_names[writer_index], features)
+                writer_index = (writer_index + 1) % len(writers)
+                group_written += 1
+
+            if pack_sequences:
+                profile.unpacked_examples += packer.examples
+                profile.unpacked_tokens += packer.tokens
+
+            # flush buffered rows between groups so nothing accumulates
+            if pipelined_writer is not None:
+                pipelined_writer.flush()
+            for _, csvfile in writers:
+                csvfile.flush()
+            gc.collect()
 
+            rss, peak = memory_usage_mb()
+            rss = "unknown" if rss is None else f"{rss:.0f} MB"
+            logging.info(
+                f"Input group {group_index + 1}/{len(groups)}: {len(group)} files, "
+                f"{group_written} examples, RSS {rss}, peak RSS {peak:.0f} MB"
+            )
+
+    if pipelined_writer is not None:
+        pipelined_writer.close()
     for writer, csvfile in writers:
         csvfile.close()
-    return total_written
+    if uncached is not None:
+        mlm_only_processor.text_to_tokenized_documents = uncached
+    if cache is not None:
+        cache.report()
+        profile.cache_hits, profile.cache_misses = cache.hits, cache.misses
+        cache.close()
+    return profile
 
 
-def main():
-    args = parse_args()
+def read_input_files(metadata_files):
+    """Input file entries listed in the metadata files, in order."""
+    input_files = []
+    for metadata_file in metadata_files:
+        with open(metadata_file, 'r') as fin:
+            input_files.extend(line.strip() for line in fin if line.strip())
+    return input_files
+
+
+def worker_pool(num_workers):
+    """
+    Process pool whose workers fork from this process, so they keep the
+    --fast_tokenizer and share_tokenizer_loads() patches and the objects
+    already loaded. Under spawn or forkserver they would silently miss them.
+    """
+    return multiprocessing.get_context("fork").Pool(num_workers)
 
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
 
+def derive_seed(seed, shard, group):
+    """
+    Seed for input group `group` of worker `shard`, spawned from a
+    SeedSequence of seed. Unlike seed + shard or seed + group, no two
+    (shard, group) pairs of one run can end up with the same seed.
+    """
+    if seed is None:
+        return None
+    seed_sequence = np.random.SeedSequence(seed % 2**32, spawn_key=(shard, group))
+    return int(seed_sequence.generate_state(1)[0])
+
+
+def create_csv_sharded(
+        num_workers,
+        metadata_files,
+        filename_prefix,
+        output_dir,
+        num_output_files,
+        seed=None,
+        pool=None,
+        **kwargs,
+):
+    """
+    Run create_csv on num_workers processes, each over a contiguous share
+    of the input files listed in metadata_files. The tasks run on pool if
+    given, otherwise on a pool of their own.
+
+    Worker k writes {filename_prefix}-shard{k}-<i>.csv with seeds from
+    derive_seed(seed, k, group), so the output is reproducible for a given
+    seed and num_workers. The num_output_files output files are divided
+    between the workers, so there are never more workers than files.
+    The workers only read the token cache; their new entries are merged
+    into it here once they finish, so this process is its only writer.
+    Returns the DatasetProfile of each worker.
+    """
+    input_files = read_input_files(metadata_files)
+    num_output_files = max(num_output_files, 1)
+    num_workers = max(1, min(num_workers, len(input_files), num_output_files))
+    token_cache = kwargs.get("token_cache")
+    if token_cache:
+        # create the table before the workers open the cache read-only
+        _open_document_table(token_cache).close()
+
+    with contextlib.ExitStack() as stack:
+        meta_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        if pool is None:
+            pool = stack.enter_context(worker_pool(num_workers))
+        results = []
+        for shard in range(num_workers):
+            shard_files = input_files[
+                len(input_files) * shard // num_workers:len(input_files) * (shard + 1) // num_workers
+            ]
+            shard_metadata_file = os.path.join(meta_dir, f"meta_shard{shard}.txt")
+            with open(shard_metadata_file, 'w') as fout:
+                fout.writelines(f"{input_file}\n" for input_file in shard_files)
+            results.append(pool.apply_async(
+                create_csv,
+                kwds=dict(
+                    kwargs,
+                    metadata_files=[shard_metadata_file],
+                    filename_prefix=f"{filename_prefix}-shard{shard}",
+                    output_dir=output_dir,
+                    num_output_files=(
+                        num_output_files * (shard + 1) // num_workers
+                        - num_output_files * shard // num_workers
+                    ),
+                    seed=seed,
+                    shard=shard,
+                    token_cache_updates=(
+                        os.path.join(meta_dir, f"token_cache_shard{shard}.sqlite") if token_cache else None
+                    ),
+                ),
+            ))
+        profiles = [result.get() for result in results]
+        if token_cache:
+            for shard in range(num_workers):
+                updates_path = os.path.join(meta_dir, f"token_cache_shard{shard}.sqlite")
+                if os.path.exists(updates_path):
+                    TokenizedDocumentCache.merge_updates(token_cache, updates_path)
+        return profiles
+
+
+def use_fast_tokenizer():
+    """Have data_generator build wordpiece.FullTokenizer instead of modelzoo's."""
+    if hasattr(mlm_only_processor, "FullTokenizer"):
+        mlm_only_processor.FullTokenizer = wordpiece.FullTokenizer
+    else:
+        logging.warning(
+            "mlm_only_processor has no FullTokenizer; --fast_tokenizer is ignored"
+        )
+
+
+def memoize_load(load):
+    """
+    Wrap load so that calls with the same arguments, whether passed by
+    position or by keyword, share the object built by the first call.
+    """
+    signature = inspect.signature(load)
+    loaded = {}
+
+    @functools.wraps(load)
+    def memoized(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = repr(list(bound.arguments.items()))
+        if key not in loaded:
+            loaded[key] = load(*args, **kwargs)
+        return loaded[key]
+
+    return memoized
+
+
+def share_tokenizer_loads(vocab_file, do_lower_case, spacy_model):
+    """
+    Memoize the tokenizer and spaCy model that data_generator builds on
+    every call, and load both now. Every split generated in this process,
+    and every worker forked from it afterwards, then shares this one load
+    of each.
+    """
+    if hasattr(mlm_only_processor, "FullTokenizer"):
+        mlm_only_processor.FullTokenizer = memoize_load(mlm_only_processor.FullTokenizer)
+        mlm_only_processor.FullTokenizer(vocab_file, do_lower_case)
+    try:
+        import spacy
+    except ImportError:
+        return
+    spacy.load = memoize_load(spacy.load)
+    try:
+        spacy.load(spacy_model)
+    except OSError as error:
+        logging.warning(f"Could not preload spaCy model '{spacy_model}': {error}")
+
+
+def split_args(args, split):
+    """Copy of args with {split} filled in for one of several --splits."""
+    args_copy = copy.copy(args)
+    args_copy.metadata_files = [
+        metadata_file.format(split=split) for metadata_file in args.metadata_files
+    ]
+    args_copy.input_files_prefix = args.input_files_prefix.format(split=split)
+    args_copy.output_dir = args.output_dir.format(split=split)
+    args_copy.name = args.name.format(split=split)
+    args_copy.splits = None
+    args_copy.split = split
+    return args_copy
+
+
+def generate_csvs(args, pool=None):
+    if args.pack_sequences and args.allow_cross_document_examples:
+        raise ValueError(
+            "--pack_sequences keeps examples whole and cannot be combined with "
+            "--allow_cross_document_examples"
+        )
+    if args.pack_sequences and args.output_format != "tokens":
+        # BertCSVDynamicMaskDataProcessor would let packed examples attend
+        # to each other; only the token shard loader masks between them
+        raise ValueError("--pack_sequences requires --output_format tokens")
     check_and_create_output_dirs(args.output_dir, filetype="csv")
 
-    total_written = create_csv(
+    csv_kwargs = dict(
         metadata_files=args.metadata_files,
         vocab_file=args.vocab_file,
         do_lower_case=args.do_lower_case,
@@ -318,36 +1111,92 @@ def main():
         filename_prefix=args.name,
         output_dir=args.output_dir,
         num_output_files=args.num_output_files,
+        write_queue_size=args.write_queue_size,
+        write_batch_size=args.write_batch_size,
+        write_buffer_size=args.write_buffer_size,
+        split_num=args.split_num,
+        output_format=args.output_format,
+        token_cache=args.token_cache,
+        pack_sequences=args.pack_sequences,
+        pack_buffer_size=args.pack_buffer_size,
     )
+    if args.num_workers > 1:
+        shard_profiles = create_csv_sharded(args.num_workers, pool=pool, **csv_kwargs)
+        profile = DatasetProfile()
+        for shard_profile in shard_profiles:
+            profile.merge(shard_profile)
+    else:
+        shard_profiles = None
+        profile = create_csv(**csv_kwargs)
 
     # Store arguments used for csv generation into a json file.
     params = vars(args)
-    params["n_examples"] = total_written
-    # params["n_docs"] = count_total_documents(args.metadata_files)
-    # [SHREYA MADE CHANGES]
-    try:
-        params["n_docs"] = count_total_documents(args.metadata_files)
-    except Exception as e:
-        print(f"Warning: Failed to count documents due to: {e}")
-        params["n_docs"] = "Unknown"
+    params["n_examples"] = profile.n_examples
+    if shard_profiles is not None:
+        params["n_examples_per_shard"] = [
+            shard_profile.n_examples for shard_profile in shard_profiles
+        ]
+    # counted while generating instead of re-reading every input
+    # (count_total_documents), which often failed and recorded "Unknown"
+    params.update(profile.to_params())
     json_params_file = os.path.join(args.output_dir, "data_params.json")
     with open(json_params_file, 'w') as _fout:
         json.dump(params, _fout)
 
-    # Create meta file.
+    # Create meta file from the rows counted per file.
     with open(f"{args.output_dir}/meta.dat", "w") as fout:
-        for file_name in os.listdir(args.output_dir):
+        for file_name, num_rows in profile.rows_per_file.items():
+            fout.write(f"{file_name} {num_rows}\n")
 
-            if file_name.startswith(args.name):
-                # Calculate number of lines in the input data.
-                num_lines = sp.run(
-                    f"wc -l {args.output_dir}/{file_name}".split(" "),
-                    stdout=sp.PIPE,
-                )
-                num_lines = int(num_lines.stdout.decode("utf-8").split(" ")[0])
+    if args.output_format == "tokens":
+        write_token_index(
+            args.output_dir,
+            [file_name[:-len(".bin")] for file_name in profile.rows_per_file],
+            TokenIdEncoder(args.vocab_file).dtype,
+            args.vocab_file,
+            segments=args.pack_sequences,
+        )
+
+    logging.info(
+        f"{profile.n_examples} examples, token lengths p50/p99/max "
+        f"{profile.percentile(50)}/{profile.percentile(99)}/{profile.percentile(100)}; "
+        f"recommended max_sequence_length for roberta_params_OCELOT_MS.yaml: "
+        f"{profile.recommended_max_sequence_length()}"
+    )
+    if args.pack_sequences:
+        logging.info(
+            f"Packed {profile.unpacked_examples} examples into {profile.n_examples} sequences; "
+            f"padding efficiency (real / padded tokens) "
+            f"{profile.unpacked_padding_efficiency():.1%} -> {profile.padding_efficiency():.1%}"
+        )
+    else:
+        logging.info(f"Padding efficiency (real / padded tokens) {profile.padding_efficiency():.1%}")
+
+
+def main():
+    args = parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
 
-                # The first line is dedicated to the header.
-                fout.write(f"{file_name} {num_lines - 1}\n")
+    if args.fast_tokenizer:
+        use_fast_tokenizer()
+    # data_generator runs once per split, worker and --split_num group
+    if args.splits or args.num_workers > 1 or (
+            args.split_num and len(read_input_files(args.metadata_files)) > args.split_num):
+        ## load before the workers fork, so they inherit the loaded objects
+        share_tokenizer_loads(args.vocab_file, args.do_lower_case, args.spacy_model)
+    with contextlib.ExitStack() as stack:
+        ## one pool serves every split
+        pool = None
+        if args.num_workers > 1:
+            pool = stack.enter_context(worker_pool(args.num_workers))
+        if args.splits:
+            for split in args.splits:
+                logging.info(f"Generating CSVs for split '{split}'")
+                generate_csvs(split_args(args, split), pool)
+        else:
+            generate_csvs(args, pool)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 #!/usr/bin/env bash
 
 ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
+# build_vocab.sh output when the workflow sets VOCAB_FILE
+VOCAB_FILE=${VOCAB_FILE:-${ENTRY_LOCATION}/tokenizer/materials_string_OCELOT.txt}
 
 # TODO: This substep will run on CPU (Neocortex or Bridges-2)
 #csvs from tokenization VAL dDOF
-python3 create_csv_mlm_only.py --name preprocessed_data_val --input_files_prefix ${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/pretraining/val --metadata_files ${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/pretraining/val/meta.txt --vocab_file ${ENTRY_LOCATION}/tokenizer/materials_string_OCELOT.txt --output_dir ${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/csvs/val
+mkdir -p ${ENTRY_LOCATION}/cache
+python3 create_csv_mlm_only.py --name preprocessed_data_val --input_files_prefix ${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/pretraining/val --metadata_files ${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/pretraining/val/meta.txt --vocab_file ${VOCAB_FILE} --output_dir ${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/csvs/val --num_workers ${SLURM_CPUS_PER_TASK:-1} --write_queue_size 64 --write_buffer_size 8388608 --token_cache ${ENTRY_LOCATION}/cache/tokenized_documents.sqlite
 
 tar cvzf ${ENTRY_LOCATION}/csv_val.tgz --directory=${ENTRY_LOCATION}/pretrain_OCELOT/pretrain_MS_0.0001/csvs/ val
\ No newline at end of file
@@ -1,20 +1,168 @@
 import argparse
+import hashlib
+import itertools
+import json
+import math
 import os
 import random
+import tempfile
 
-def split_up_textfile(text_file, output_dir, chunk_size=1000, seed=42):
+import numpy as np
+
+# Split 80:10:10
+TRAIN_FRACTION = 0.8
+VAL_FRACTION = 0.1
+SPLIT_NAMES = ("train", "val", "test")
+SPLIT_STATE_FILE = "split_state.json"
+FINGERPRINTS_FILE = "fingerprints.bin"
+# lines read and deduped at a time by the streaming and incremental splits
+BLOCK_LINES = 1 << 16
+
+
+def line_fingerprint(line):
+    return int.from_bytes(hashlib.blake2b(line.encode(), digest_size=8).digest(), 'big')
+
+
+class LineDeduper:
+    """Drop exact duplicate lines by remembering a 64-bit fingerprint of each line kept.
+
+    The fingerprints are held in a few sorted np.uint64 runs, 8 bytes per
+    line, each at least twice the size of the next; a new block becomes the
+    smallest run and is merged upwards like a binary counter. Merging the
+    largest run briefly needs as much again, hence BYTES_PER_LINE. Lines
+    are checked a block at a time with filter_new(). A false positive needs
+    a 64-bit hash collision.
+    """
+
+    BYTES_PER_LINE = 16
+
+    def __init__(self):
+        self.runs = []
+        self.total = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def _seen(self, fingerprints):
+        seen = np.zeros(len(fingerprints), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, fingerprints), len(run) - 1)
+            seen |= run[positions] == fingerprints
+        return seen
+
+    def _add(self, fingerprints):
+        """Add sorted, unique fingerprints that are not in any run yet."""
+        if not len(fingerprints):
+            return
+        self.runs.append(fingerprints)
+        while len(self.runs) > 1 and len(self.runs[-2]) < 2 * len(self.runs[-1]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            # two sorted runs: the stable sort merges them in linear time
+            self.runs.append(np.sort(np.concatenate((older, newer)), kind='stable'))
+
+    def filter_new(self, lines):
+        """Return the lines not seen before, in this block or an earlier one, in their original order."""
+        self.total += len(lines)
+        if not lines:
+            return []
+        fingerprints = np.fromiter((line_fingerprint(line) for line in lines), dtype=np.uint64, count=len(lines))
+        unique, first = np.unique(fingerprints, return_index=True)
+        new = ~self._seen(unique)
+        self._add(unique[new])
+        keep = np.zeros(len(lines), dtype=bool)
+        keep[first[new]] = True
+        kept = [line for line, is_new in zip(lines, keep.tolist()) if is_new]
+        self.duplicates += len(lines) - len(kept)
+        return kept
+
+    def load(self, path):
+        # fingerprints.bin from older runs is not sorted
+        fingerprints = np.unique(np.fromfile(path, dtype=np.uint64))
+        self._add(fingerprints[~self._seen(fingerprints)])
+
+    def save(self, path):
+        np.concatenate(self.runs or [np.empty(0, dtype=np.uint64)]).tofile(path)
+
+    def report(self):
+        ratio = self.duplicates / self.total if self.total else 0.
+        print(f"[INFO] Dedupe: dropped {self.duplicates} of {self.total} lines ({ratio:.2%}), "
+              f"kept {self.total - self.duplicates}")
+
+
+def count_lines(text_file):
+    with open(text_file, 'rb') as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+
+
+class ChunkWriter:
+    """Write lines into smiles_<i>.txt files of chunk_size lines each, then list them in meta.txt.
+
+    Numbering starts at first_chunk; close(meta_mode='a') appends the new
+    files to an existing meta.txt instead of replacing it.
+    """
+
+    def __init__(self, split_dir, chunk_size, first_chunk=0):
+        os.makedirs(split_dir, exist_ok=True)
+        self.split_dir = split_dir
+        self.chunk_size = chunk_size
+        self.first_chunk = first_chunk
+        self.chunk_files = []
+        self.lines = 0
+        self.f = None
+
+    def write(self, line):
+        # Chunk into files
+        if self.lines % self.chunk_size == 0:
+            if self.f is not None:
+                self.f.close()
+            filename = os.path.join(self.split_dir, f"smiles_{self.first_chunk + len(self.chunk_files)}.txt")
+            self.chunk_files.append(os.path.abspath(filename))
+            self.f = open(filename, 'w')
+        self.f.write(line + "\n")
+        self.lines += 1
+
+    def close(self, meta_mode='w'):
+        if self.f is not None:
+            self.f.close()
+        # Write corresponding meta.txt
+        with open(os.path.join(self.split_dir, 'meta.txt'), meta_mode) as meta:
+            for filename in self.chunk_files:
+                meta.write(filename + "\n")
+        return self.chunk_files
+
+
+def write_split(split_dir, lines, chunk_size):
+    """Write lines into smiles_<i>.txt files of chunk_size lines each, plus meta.txt listing them."""
+    writer = ChunkWriter(split_dir, chunk_size)
+    for line in lines:
+        writer.write(line)
+    return writer.close()
+
+
+def split_sizes(total):
+    n_train = int(TRAIN_FRACTION * total)
+    n_val = int(VAL_FRACTION * total)
+    return n_train, n_val, total - n_train - n_val
+
+
+def split_up_textfile(text_file, output_dir, chunk_size=1000, seed=42, dedupe=False):
     # Read all lines
     with open(text_file, 'r') as f:
         lines = [line.strip() for line in f if line.strip()]
-    
+
+    # Drop duplicates before shuffling so no line can land in two splits
+    if dedupe:
+        deduper = LineDeduper()
+        lines = deduper.filter_new(lines)
+        deduper.report()
+
     # Shuffle with seed
     random.seed(seed)
     random.shuffle(lines)
 
-    # Split 80:10:10
-    total = len(lines)
-    n_train = int(0.8 * total)
-    n_val = int(0.1 * total)
+    n_train, n_val, _ = split_sizes(len(lines))
 
     splits = {
         "train": lines[:n_train],
@@ -23,22 +171,181 @@ def split_up_textfile(text_file, output_dir, chunk_size=1000, seed=42):
     }
 
     for split_name, data in splits.items():
-        split_dir = os.path.join(output_dir, split_name)
-        os.makedirs(split_dir, exist_ok=True)
+        write_split(os.path.join(output_dir, split_name), data, chunk_size)
 
-        # Chunk into files
-        for i in range(0, len(data), chunk_size):
-            chunk = data[i:i+chunk_size]
-            filename = f"smiles_{i//chunk_size}.txt"
-            with open(os.path.join(split_dir, filename), 'w') as f:
-                for line in chunk:
-                    f.write(line + "\n")
 
-        # Write corresponding meta.txt
-        with open(os.path.join(split_dir, 'meta.txt'), 'w') as meta:
-            for i in range(0, len(data), chunk_size):
-                filename = os.path.abspath(os.path.join(split_dir, f"smiles_{i//chunk_size}.txt"))
+def scatter_lines(text_file, bucket_dir, num_buckets, rng, deduper=None):
+    """First pass of the external shuffle: send each line to a random bucket file.
+
+    Lines rejected by deduper are skipped. Returns the bucket paths and the
+    number of lines written.
+    """
+    bucket_paths = [os.path.join(bucket_dir, f"bucket_{i}.txt") for i in range(num_buckets)]
+    buckets = [open(path, 'w') for path in bucket_paths]
+    total = 0
+    with open(text_file, 'r') as f:
+        for block in iter(lambda: list(itertools.islice(f, BLOCK_LINES)), []):
+            lines = [line for line in (raw.strip() for raw in block) if line]
+            if deduper is not None:
+                lines = deduper.filter_new(lines)
+            for line in lines:
+                buckets[rng.randrange(num_buckets)].write(line + "\n")
+            total += len(lines)
+    for bucket in buckets:
+        bucket.close()
+    return bucket_paths, total
+
+
+def gather_lines(bucket_paths, rng):
+    """Second pass of the external shuffle: shuffle each bucket in memory and yield its lines."""
+    for path in bucket_paths:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+        os.remove(path)
+        rng.shuffle(lines)
+        yield from lines
+
+
+def split_up_textfile_streaming(text_file, output_dir, chunk_size=1000, seed=42, max_memory_mb=1024,
+                                tmp_dir=None, dedupe=False):
+    """Same 80:10:10 split as split_up_textfile without holding the corpus in memory.
+
+    Lines are scattered into enough temporary bucket files that each one fits
+    in max_memory_mb, then every bucket is shuffled in memory and streamed
+    into the train, val and test chunk files in turn. The order is
+    reproducible for a given seed and max_memory_mb (which fixes the number
+    of buckets) but differs from the in-memory shuffle.
+
+    With dedupe, the fingerprints of the first pass are held in memory
+    until it ends, before any bucket is loaded; they must fit in
+    max_memory_mb too.
+    """
+    # a loaded line costs a few times its size on disk as a Python str in a list
+    bucket_bytes = max_memory_mb * 1e6 / 4
+    num_buckets = max(1, math.ceil(os.path.getsize(text_file) / bucket_bytes))
+    print(f"[INFO] Shuffling {text_file} through {num_buckets} buckets")
+
+    deduper = None
+    if dedupe:
+        n_lines = count_lines(text_file)
+        dedupe_mb = n_lines * LineDeduper.BYTES_PER_LINE / 1e6
+        if dedupe_mb > max_memory_mb:
+            raise ValueError(f"Deduping {n_lines} lines needs up to {dedupe_mb:.0f} MB; "
+                             f"raise --max_memory_mb above {max_memory_mb}")
+        print(f"[INFO] Dedupe fingerprints: up to {dedupe_mb:.0f} MB for {n_lines} lines")
+        deduper = LineDeduper()
+
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory(dir=tmp_dir or output_dir) as bucket_dir:
+        bucket_paths, total = scatter_lines(text_file, bucket_dir, num_buckets, rng, deduper)
+        if deduper is not None:
+            deduper.report()
+            # freed before the buckets are loaded
+            deduper = None
+        n_train, n_val, _ = split_sizes(total)
+
+        lines = gather_lines(bucket_paths, rng)
+        write_split(os.path.join(output_dir, "train"), itertools.islice(lines, n_train), chunk_size)
+        write_split(os.path.join(output_dir, "val"), itertools.islice(lines, n_val), chunk_size)
+        write_split(os.path.join(output_dir, "test"), lines, chunk_size)
+
+
+def hash_split(line, key):
+    """Stable split for a line: a keyed 64-bit hash read as a fraction of 2**64."""
+    digest = hashlib.blake2b(line.encode(), digest_size=8, key=key).digest()
+    fraction = int.from_bytes(digest, 'big') / 2 ** 64
+    if fraction < TRAIN_FRACTION:
+        return "train"
+    if fraction < TRAIN_FRACTION + VAL_FRACTION:
+        return "val"
+    return "test"
+
+
+def count_chunks(split_dir):
+    meta_path = os.path.join(split_dir, 'meta.txt')
+    if not os.path.exists(meta_path):
+        return 0
+    with open(meta_path, 'r') as meta:
+        return sum(1 for line in meta if line.strip())
+
+
+def split_up_textfile_incremental(text_file, output_dir, chunk_size=1000, seed=42, dedupe=False):
+    """Append-only 80:10:10 split keyed on a hash of each line.
+
+    Lines already split on an earlier run are never moved or rewritten: the
+    text file may only grow by appending, which is checked against the size
+    and SHA-256 of the prefix recorded in split_state.json. New lines go to
+    new chunk files, which are appended to each split's meta.txt and also
+    listed on their own in new_meta.txt so downstream steps can process just
+    those. With dedupe, the fingerprints of every line kept so far are
+    stored in fingerprints.bin so duplicates of earlier lines are dropped too.
+    """
+    state_path = os.path.join(output_dir, SPLIT_STATE_FILE)
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        if state['seed'] != seed:
+            raise ValueError(f"{output_dir} was split with seed {state['seed']}, not {seed}")
+        if state['dedupe'] != dedupe:
+            raise ValueError(f"{output_dir} was split with dedupe={state['dedupe']}, not {dedupe}")
+    else:
+        if any(count_chunks(os.path.join(output_dir, split_name)) for split_name in SPLIT_NAMES):
+            raise ValueError(f"{output_dir} already holds a split that was not made with --incremental")
+        state = {'seed': seed, 'dedupe': dedupe, 'bytes': 0, 'sha256': hashlib.sha256().hexdigest(), 'lines': 0}
+
+    deduper = None
+    fingerprints_path = os.path.join(output_dir, FINGERPRINTS_FILE)
+    if dedupe:
+        deduper = LineDeduper()
+        if os.path.exists(fingerprints_path):
+            deduper.load(fingerprints_path)
+
+    key = str(seed).encode()
+    digest = hashlib.sha256()
+    with open(text_file, 'rb') as f:
+        remaining = state['bytes']
+        while remaining > 0:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+        if remaining > 0 or digest.hexdigest() != state['sha256']:
+            raise ValueError(f"{text_file} changed other than by appending lines since the last run; "
+                             "re-split it without --incremental")
+
+        writers = {split_name: ChunkWriter(os.path.join(output_dir, split_name), chunk_size,
+                                           first_chunk=count_chunks(os.path.join(output_dir, split_name)))
+                   for split_name in SPLIT_NAMES}
+        for block in iter(lambda: list(itertools.islice(f, BLOCK_LINES)), []):
+            complete = block if block[-1].endswith(b"\n") else block[:-1]
+            for raw in complete:
+                digest.update(raw)
+                state['bytes'] += len(raw)
+            lines = [line for line in (raw.decode().strip() for raw in complete) if line]
+            if deduper is not None:
+                lines = deduper.filter_new(lines)
+            for line in lines:
+                writers[hash_split(line, key)].write(line)
+            state['lines'] += len(lines)
+            if len(complete) < len(block):
+                print("[INFO] Last line has no trailing newline; leaving it for the next run")
+                break
+
+    for split_name, writer in writers.items():
+        new_files = writer.close(meta_mode='a')
+        with open(os.path.join(output_dir, split_name, 'new_meta.txt'), 'w') as meta:
+            for filename in new_files:
                 meta.write(filename + "\n")
+        print(f"[INFO] {split_name}: {writer.lines} new lines in {len(new_files)} new chunk files")
+
+    if deduper is not None:
+        deduper.save(fingerprints_path)
+        deduper.report()
+    state['sha256'] = digest.hexdigest()
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -46,9 +353,28 @@ def main():
     parser.add_argument('--output_dir', required=True, help="Directory to write split and chunked files")
     parser.add_argument('--chunk_size', type=int, default=1000, help="Number of lines per chunk file")
     parser.add_argument('--seed', type=int, default=42, help="Random seed for shuffling")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Shuffle through temporary bucket files on disk instead of in memory")
+    parser.add_argument('--max_memory_mb', type=int, default=1024,
+                        help="Approximate memory bound for --streaming; sets the number of buckets")
+    parser.add_argument('--tmp_dir', default=None,
+                        help="Where --streaming puts its bucket files; defaults to output_dir")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Assign lines to splits by a stable hash and only append chunks for lines "
+                             "added to text_file since the last --incremental run")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="Drop exact duplicate lines so that no line is in more than one split")
     args = parser.parse_args()
 
-    split_up_textfile(args.text_file, args.output_dir, args.chunk_size, args.seed)
+    if args.incremental:
+        os.makedirs(args.output_dir, exist_ok=True)
+        split_up_textfile_incremental(args.text_file, args.output_dir, args.chunk_size, args.seed, args.dedupe)
+    elif args.streaming:
+        os.makedirs(args.output_dir, exist_ok=True)
+        split_up_textfile_streaming(args.text_file, args.output_dir, args.chunk_size, args.seed,
+                                    args.max_memory_mb, args.tmp_dir, args.dedupe)
+    else:
+        split_up_textfile(args.text_file, args.output_dir, args.chunk_size, args.seed, args.dedupe)
 
 if __name__ == "__main__":
     main()
@@ -19,13 +19,29 @@ MODELZOO_PATH = os.getenv(key='MODELZOO_PATH', default='/ocean/neocortex/cerebra
 sys.path.append(MODELZOO_PATH)
 
 from modelzoo.common.pytorch.run_utils import run
-from modelzoo.transformers.pytorch.bert.data import (
-    eval_input_dataloader,
-    train_input_dataloader,
-)
+from modelzoo.transformers.pytorch.bert import data
 from modelzoo.transformers.pytorch.bert.model import BertForPreTrainingModel
 from modelzoo.transformers.pytorch.bert.utils import set_defaults
 
+from token_shard_processor import PROCESSOR_NAME, BertTokenShardDataProcessor
+
+
+def train_input_dataloader(params):
+    """Select the token-ID shard loader through train_input.data_processor."""
+    if params["train_input"].get("data_processor") == PROCESSOR_NAME:
+        return BertTokenShardDataProcessor(params["train_input"]).create_dataloader(
+            is_training=True
+        )
+    return data.train_input_dataloader(params)
+
+
+def eval_input_dataloader(params):
+    if params["eval_input"].get("data_processor") == PROCESSOR_NAME:
+        return BertTokenShardDataProcessor(params["eval_input"]).create_dataloader(
+            is_training=False
+        )
+    return data.eval_input_dataloader(params)
+
 
 def main():
     run(
@@ -0,0 +1,156 @@
+# Copyright 2022 Cerebras Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Dataloader for the binary token-ID shards written by
+create_csv_mlm_only.py --output_format tokens.
+
+It stands in for BertCSVDynamicMaskDataProcessor with disable_nsp: the
+same dynamic masking and the same feature names, but examples come from
+memory-mapped token ids instead of parsing CSV text. attention_mask stays
+the [max_sequence_length] key mask the modelzoo BERT expects. Shards of
+packed sequences add a segment_ids feature numbering the packed examples
+from 1 (0 is padding). The modelzoo BERT ignores it, so packed examples
+still attend to each other unless the model turns segment_ids into an
+attention mask with block_diagonal_mask().
+"""
+import numpy as np
+import torch
+
+from token_shards import SPECIAL_TOKENS, TokenShardDirectory, load_vocab
+
+PROCESSOR_NAME = "BertTokenShardDataProcessor"
+
+
+def packed_segment_ids(segment_lengths, length, max_sequence_length):
+    """Segment number (from 1) of each of the first `length` positions; 0 past them."""
+    segment_ids = np.zeros(max_sequence_length, dtype=np.int32)
+    segment_ids[:length] = np.repeat(
+        np.arange(1, len(segment_lengths) + 1), np.asarray(segment_lengths, dtype=np.int64)
+    )[:length]
+    return segment_ids
+
+
+def block_diagonal_mask(segment_ids):
+    """
+    [..., S, S] attention mask from [..., S] segment_ids: each position
+    attends only to its own segment. Padding (segment 0) attends only to
+    itself, so no row is empty and an additive mask cannot turn it into NaN.
+    """
+    segment_ids = np.asarray(segment_ids)
+    same = segment_ids[..., :, None] == segment_ids[..., None, :]
+    mask = same & (segment_ids[..., :, None] != 0)
+    mask |= np.eye(segment_ids.shape[-1], dtype=bool)
+    return mask.astype(np.int32)
+
+
+class TokenShardDataset(torch.utils.data.Dataset):
+    def __init__(self, params, is_training):
+        self.shards = TokenShardDirectory(params["data_dir"])
+        vocab = load_vocab(params.get("vocab_file", self.shards.vocab_file))
+        self.vocab_size = len(vocab)
+        self.pad_id = vocab.get("[PAD]", 0)
+        self.mask_id = vocab["[MASK]"]
+        self.special_ids = np.array(
+            [vocab[token] for token in SPECIAL_TOKENS if token in vocab]
+        )
+        self.max_sequence_length = params["max_sequence_length"]
+        self.max_predictions_per_seq = params["max_predictions_per_seq"]
+        self.masked_lm_prob = params.get("masked_lm_prob", 0.15)
+        self.seed = params.get("shuffle_seed", 1)
+        self.is_training = is_training
+        self._train_rng = None
+        self._train_rng_seed = None
+
+    def __len__(self):
+        return len(self.shards)
+
+    def _rng(self, index):
+        if self.is_training:
+            # one stream per worker process, kept across epochs so that
+            # persistent workers (or num_workers=0) mask differently on
+            # every epoch; reseeded only when the process seed changes
+            seed = torch.initial_seed() % 2 ** 32
+            if self._train_rng_seed != seed:
+                self._train_rng = np.random.default_rng(seed)
+                self._train_rng_seed = seed
+            return self._train_rng
+        # eval masking is the same on every pass
+        return np.random.default_rng([self.seed, index])
+
+    def __getitem__(self, index):
+        msl = self.max_sequence_length
+        max_predictions = self.max_predictions_per_seq
+        ids = self.shards[index][:msl].astype(np.int32)
+        rng = self._rng(index)
+
+        candidates = np.flatnonzero(~np.isin(ids, self.special_ids))
+        num_to_mask = min(
+            max_predictions,
+            max(1, int(round(len(ids) * self.masked_lm_prob))),
+            len(candidates),
+        )
+        positions = np.sort(rng.choice(candidates, num_to_mask, replace=False))
+        labels = ids[positions]
+
+        # 80% [MASK], 10% random token, 10% unchanged
+        input_ids = ids.copy()
+        draw = rng.random(num_to_mask)
+        input_ids[positions[draw < 0.8]] = self.mask_id
+        random_positions = positions[(draw >= 0.8) & (draw < 0.9)]
+        input_ids[random_positions] = rng.integers(
+            0, self.vocab_size, len(random_positions)
+        )
+
+        features = {
+            "input_ids": np.full(msl, self.pad_id, dtype=np.int32),
+            "attention_mask": np.zeros(msl, dtype=np.int32),
+            "token_type_ids": np.zeros(msl, dtype=np.int32),
+            "masked_lm_positions": np.zeros(max_predictions, dtype=np.int32),
+            "masked_lm_mask": np.zeros(max_predictions, dtype=np.int32),
+            "labels": np.zeros(max_predictions, dtype=np.int32),
+        }
+        features["input_ids"][:len(ids)] = input_ids
+        features["attention_mask"][:len(ids)] = 1
+        segment_lengths = self.shards.segment_lengths(index)
+        if segment_lengths is not None:
+            features["segment_ids"] = packed_segment_ids(segment_lengths, len(ids), msl)
+        features["masked_lm_positions"][:num_to_mask] = positions
+        features["masked_lm_mask"][:num_to_mask] = 1
+        features["labels"][:num_to_mask] = labels
+        return features
+
+
+class BertTokenShardDataProcessor:
+    def __init__(self, params):
+        self.params = params
+        self.batch_size = params["batch_size"]
+        self.shuffle = params.get("shuffle", False)
+        self.shuffle_seed = params.get("shuffle_seed", 1)
+        self.num_workers = params.get("num_workers", 0)
+        self.drop_last = params.get("drop_last_batch", True)
+
+    def create_dataloader(self, is_training=True):
+        dataset = TokenShardDataset(self.params, is_training)
+        generator = torch.Generator()
+        generator.manual_seed(self.shuffle_seed)
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            shuffle=self.shuffle,
+            generator=generator,
+            num_workers=self.num_workers,
+            drop_last=self.drop_last,
+            persistent_workers=self.num_workers > 0,
+        )
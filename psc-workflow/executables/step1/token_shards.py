@@ -0,0 +1,196 @@
+# Copyright 2022 Cerebras Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Binary token-ID shards for MLM pretraining data.
+
+A shard is a pair of files:
+
+    <name>.bin   token ids of every example back to back, as uint16 when
+                 the vocab fits (uint32 otherwise), without padding
+    <name>.idx   .npy array of n_examples + 1 uint64 offsets into .bin
+
+Shards of packed sequences (--pack_sequences) add the length of every
+example packed into each sequence:
+
+    <name>.seg      .npy array of uint32 segment lengths, back to back
+    <name>.segidx   .npy array of n_examples + 1 uint64 offsets into .seg
+
+token_shards.json in the output directory records the dtype, the vocab,
+whether there are segments and the shard names. TokenShardReader maps both files read-only and returns
+each example as a view of the map, so reading never copies or parses text.
+"""
+import ast
+import json
+import os
+
+import numpy as np
+
+from wordpiece import load_vocab
+
+TOKEN_INDEX_FILE = "token_shards.json"
+SPECIAL_TOKENS = ("[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]")
+
+
+def token_dtype(vocab_size):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+class TokenIdEncoder:
+    """Turn the features yielded by data_generator into an array of token ids."""
+
+    def __init__(self, vocab_file):
+        self.vocab = load_vocab(vocab_file)
+        self.dtype = token_dtype(max(self.vocab.values(), default=0) + 1)
+        self.unk_id = self.vocab.get("[UNK]", 0)
+
+    def __call__(self, features):
+        # the CSV writer stores features as the repr of a list of tokens
+        tokens = ast.literal_eval(features) if isinstance(features, str) else features
+        return np.fromiter(
+            (self.vocab.get(token, self.unk_id) for token in tokens if token != "[PAD]"),
+            dtype=self.dtype,
+        )
+
+
+def _save_npy(path, values, dtype):
+    np.save(path, np.asarray(values, dtype=dtype))
+    # np.save appends .npy; keep the documented name
+    os.replace(f"{path}.npy", path)
+
+
+class TokenShardWriter:
+    """
+    Append examples (arrays of token ids) to <path>.bin and write their
+    offsets to <path>.idx on close. With segments=True each row is an
+    (ids, segment_lengths) pair and the lengths go to <path>.seg.
+
+    writerow/writerows/flush/close match the csv writer and file object
+    create_csv drives, so it can stand in for both.
+    """
+
+    def __init__(self, path, dtype, buffering=-1, segments=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.file = open(f"{path}.bin", 'wb', buffering=buffering)
+        self.offsets = [0]
+        self.segments = segments
+        self.segment_lengths = []
+        self.segment_offsets = [0]
+
+    def writerow(self, row):
+        if self.segments:
+            ids, segment_lengths = row
+            self.segment_lengths.extend(segment_lengths)
+            self.segment_offsets.append(len(self.segment_lengths))
+        else:
+            ids = row
+        ids = np.asarray(ids, dtype=self.dtype)
+        self.file.write(ids.tobytes())
+        self.offsets.append(self.offsets[-1] + len(ids))
+
+    def writerows(self, rows):
+        for ids in rows:
+            self.writerow(ids)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        _save_npy(f"{self.path}.idx", self.offsets, np.uint64)
+        if self.segments:
+            _save_npy(f"{self.path}.seg", self.segment_lengths, np.uint32)
+            _save_npy(f"{self.path}.segidx", self.segment_offsets, np.uint64)
+
+
+def write_token_index(output_dir, shard_names, dtype, vocab_file, segments=False):
+    with open(os.path.join(output_dir, TOKEN_INDEX_FILE), 'w') as fout:
+        json.dump(
+            {
+                "dtype": np.dtype(dtype).name,
+                "vocab_file": os.path.abspath(vocab_file),
+                "segments": segments,
+                "shards": list(shard_names),
+            },
+            fout,
+        )
+
+
+class TokenShardReader:
+    """
+    Memory-mapped reader for one shard. len(reader) is the number of
+    examples and reader[i] a read-only view of example i's token ids.
+    """
+
+    def __init__(self, path, dtype, segments=False):
+        self.path = path
+        self.offsets = np.load(f"{path}.idx", mmap_mode='r')
+        if os.path.getsize(f"{path}.bin"):
+            self.ids = np.memmap(f"{path}.bin", dtype=dtype, mode='r')
+        else:
+            # np.memmap refuses empty files
+            self.ids = np.empty(0, dtype=dtype)
+        if segments:
+            self.lengths = np.load(f"{path}.seg", mmap_mode='r')
+            self.segment_offsets = np.load(f"{path}.segidx", mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.ids[int(self.offsets[index]):int(self.offsets[index + 1])]
+
+    def segment_lengths(self, index):
+        """Lengths of the examples packed into example index."""
+        return self.lengths[int(self.segment_offsets[index]):int(self.segment_offsets[index + 1])]
+
+
+class TokenShardDirectory:
+    """
+    All shards listed in token_shards.json of data_dir, indexed as one
+    sequence of examples in shard order.
+    """
+
+    def __init__(self, data_dir):
+        with open(os.path.join(data_dir, TOKEN_INDEX_FILE), 'r') as fin:
+            index = json.load(fin)
+        self.dtype = np.dtype(index["dtype"])
+        self.vocab_file = index["vocab_file"]
+        self.segments = index.get("segments", False)
+        self.shards = [
+            TokenShardReader(os.path.join(data_dir, name), self.dtype, self.segments)
+            for name in index["shards"]
+        ]
+        self.starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _locate(self, index):
+        if index < 0:
+            index += len(self)
+        shard = int(np.searchsorted(self.starts, index, side='right')) - 1
+        return self.shards[shard], index - int(self.starts[shard])
+
+    def __getitem__(self, index):
+        shard, index = self._locate(index)
+        return shard[index]
+
+    def segment_lengths(self, index):
+        """Lengths of the examples packed into example index, or None if not packed."""
+        if not self.segments:
+            return None
+        shard, index = self._locate(index)
+        return shard.segment_lengths(index)
@@ -0,0 +1,290 @@
+# Copyright 2022 Cerebras Systems.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched WordPiece tokenizer giving the same tokens as the BERT FullTokenizer
+used by modelzoo.
+
+The vocab is compiled once into two character tries (word-initial pieces
+and "##" continuations) so a longest match is a single walk instead of
+trying every prefix. ASCII text, which covers the materials strings, is
+split with one regular expression; other text takes the character-by-
+character path of the reference BasicTokenizer. Words are memoized, since
+spacegroup symbols, Wyckoff labels and most numbers repeat constantly.
+
+Usable from any step, it only needs numpy:
+
+    tokenizer = WordPieceTokenizer(vocab_file, do_lower_case=False)
+    ids, offsets = tokenizer.tokenize_batch(texts)
+    # the ids of texts[i] are ids[offsets[i]:offsets[i + 1]]
+
+Run this file to benchmark it against modelzoo's FullTokenizer.
+"""
+import argparse
+import array
+import os
+import re
+import string
+import sys
+import time
+import unicodedata
+
+import numpy as np
+
+MAX_INPUT_CHARS_PER_WORD = 200
+MAX_CACHED_WORDS = 1 << 20
+
+_ASCII_PUNCTUATION = re.escape(string.punctuation)
+# words and single punctuation characters, as BasicTokenizer splits ASCII text
+_ASCII_TOKEN = re.compile(rf"[^\s{_ASCII_PUNCTUATION}]+|[{_ASCII_PUNCTUATION}]")
+# control characters that BasicTokenizer drops (tab, newline and return are whitespace)
+_ASCII_DROP = {cp: None for cp in range(32) if chr(cp) not in "\t\n\r"}
+_ASCII_DROP[127] = None
+
+
+def load_vocab(vocab_file):
+    """Map tokens to ids the way the BERT vocab loader does: id = line number."""
+    vocab = {}
+    with open(vocab_file, 'r', encoding='utf-8') as fin:
+        for index, line in enumerate(fin):
+            vocab[line.strip()] = index
+    return vocab
+
+
+def _is_whitespace(char):
+    return char in " \t\n\r" or unicodedata.category(char) == "Zs"
+
+
+def _is_control(char):
+    # only Cc and Cf, as in BERT's tokenization.py; Cn, Co and Cs are kept
+    if char in "\t\n\r":
+        return False
+    return unicodedata.category(char) in ("Cc", "Cf")
+
+
+def _is_punctuation(char):
+    cp = ord(char)
+    if 33 <= cp <= 47 or 58 <= cp <= 64 or 91 <= cp <= 96 or 123 <= cp <= 126:
+        return True
+    return unicodedata.category(char).startswith("P")
+
+
+def _is_chinese_char(cp):
+    return (0x4E00 <= cp <= 0x9FFF or 0x3400 <= cp <= 0x4DBF or 0x20000 <= cp <= 0x2A6DF
+            or 0x2A700 <= cp <= 0x2B73F or 0x2B740 <= cp <= 0x2B81F or 0x2B820 <= cp <= 0x2CEAF
+            or 0xF900 <= cp <= 0xFAFF or 0x2F800 <= cp <= 0x2FA1F)
+
+
+def _basic_tokenize_unicode(text, do_lower_case):
+    """Reference BasicTokenizer for text that is not pure ASCII."""
+    chars = []
+    for char in text:
+        cp = ord(char)
+        if cp == 0 or cp == 0xFFFD or _is_control(char):
+            continue
+        if _is_whitespace(char):
+            chars.append(" ")
+        elif _is_chinese_char(cp):
+            chars.extend((" ", char, " "))
+        else:
+            chars.append(char)
+
+    words = []
+    for token in "".join(chars).split():
+        if do_lower_case:
+            token = "".join(
+                char for char in unicodedata.normalize("NFD", token.lower())
+                if unicodedata.category(char) != "Mn"
+            )
+        current = []
+        for char in token:
+            if _is_punctuation(char):
+                if current:
+                    words.append("".join(current))
+                    current = []
+                words.append(char)
+            else:
+                current.append(char)
+        if current:
+            words.append("".join(current))
+    return words
+
+
+def basic_tokenize(text, do_lower_case):
+    if text.isascii():
+        text = text.translate(_ASCII_DROP)
+        if do_lower_case:
+            text = text.lower()
+        return _ASCII_TOKEN.findall(text)
+    return _basic_tokenize_unicode(text, do_lower_case)
+
+
+class WordPieceTokenizer:
+    """
+    Longest-match-first WordPiece over a vocab trie.
+
+    tokenize_batch() is the main API, used by step 3. tokenize(),
+    convert_tokens_to_ids(), convert_ids_to_tokens(), get_vocab_words()
+    and the vocab_file, vocab, inv_vocab and do_lower_case attributes
+    mirror FullTokenizer so an instance can be dropped in where one is
+    expected, as data_generator does in step 1.
+    """
+
+    def __init__(self, vocab_file, do_lower_case=True, unk_token="[UNK]"):
+        self.vocab_file = vocab_file
+        self.vocab = load_vocab(vocab_file)
+        self.inv_vocab = {index: token for token, index in self.vocab.items()}
+        self.do_lower_case = do_lower_case
+        self.unk_token = unk_token
+        if unk_token not in self.vocab:
+            raise ValueError(f"{vocab_file} has no {unk_token} entry")
+        self.unk_id = self.vocab[unk_token]
+        # "" marks the end of a piece and holds its id
+        self._start = {}
+        self._continuation = {}
+        for token, index in self.vocab.items():
+            if token.startswith("##") and len(token) > 2:
+                node, chars = self._continuation, token[2:]
+            else:
+                node, chars = self._start, token
+            for char in chars:
+                node = node.setdefault(char, {})
+            node[""] = index
+        self._word_ids = {}
+
+    def _wordpiece(self, word):
+        if len(word) > MAX_INPUT_CHARS_PER_WORD:
+            return (self.unk_id,)
+        ids = []
+        start = 0
+        trie = self._start
+        while start < len(word):
+            node = trie
+            end = None
+            for i in range(start, len(word)):
+                node = node.get(word[i])
+                if node is None:
+                    break
+                if "" in node:
+                    end = i + 1
+                    piece_id = node[""]
+            if end is None:
+                return (self.unk_id,)
+            ids.append(piece_id)
+            start = end
+            trie = self._continuation
+        return tuple(ids)
+
+    def _word_to_ids(self, word):
+        ids = self._word_ids.get(word)
+        if ids is None:
+            if len(self._word_ids) >= MAX_CACHED_WORDS:
+                self._word_ids.clear()
+            ids = self._word_ids[word] = self._wordpiece(word)
+        return ids
+
+    def encode(self, text):
+        """Token ids of one text, as a list."""
+        ids = []
+        for word in basic_tokenize(text, self.do_lower_case):
+            ids.extend(self._word_to_ids(word))
+        return ids
+
+    def tokenize_batch(self, texts):
+        """
+        Token ids of every text as one flat int32 array plus int64 offsets:
+        the ids of texts[i] are ids[offsets[i]:offsets[i + 1]].
+        """
+        ids = array.array('i')
+        offsets = array.array('q', [0])
+        for text in texts:
+            for word in basic_tokenize(text, self.do_lower_case):
+                ids.extend(self._word_to_ids(word))
+            offsets.append(len(ids))
+        return np.frombuffer(ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64)
+
+    def tokenize(self, text):
+        return [self.inv_vocab.get(index, self.unk_token) for index in self.encode(text)]
+
+    def convert_tokens_to_ids(self, tokens):
+        return [self.vocab[token] for token in tokens]
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.inv_vocab[index] for index in ids]
+
+    def get_vocab_words(self):
+        return list(self.vocab.keys())
+
+
+def FullTokenizer(vocab_file, do_lower_case=True):
+    """Drop-in for modelzoo's FullTokenizer(vocab_file, do_lower_case)."""
+    return WordPieceTokenizer(vocab_file, do_lower_case)
+
+
+def load_reference_tokenizer(vocab_file, do_lower_case):
+    modelzoo_path = os.getenv(key='MODELZOO_PATH', default='/ocean/neocortex/cerebras/modelzoo')
+    sys.path.append(modelzoo_path)
+    from modelzoo.transformers.data_processing.Tokenization import FullTokenizer as Reference
+
+    return Reference(vocab_file, do_lower_case)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark tokenize_batch against modelzoo's FullTokenizer"
+    )
+    parser.add_argument('--vocab_file', required=True, help="path to vocabulary")
+    parser.add_argument('--text_file', required=True, help="text to tokenize, one example per line")
+    parser.add_argument('--do_lower_case', action='store_true')
+    parser.add_argument('--max_lines', type=int, default=100000, help="number of lines to tokenize")
+    parser.add_argument('--batch_size', type=int, default=1024, help="texts per tokenize_batch call")
+    args = parser.parse_args()
+
+    with open(args.text_file, 'r', encoding='utf-8') as fin:
+        texts = [line.rstrip("\n") for _, line in zip(range(args.max_lines), fin)]
+
+    start = time.perf_counter()
+    tokenizer = WordPieceTokenizer(args.vocab_file, args.do_lower_case)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batches = [
+        tokenizer.tokenize_batch(texts[i:i + args.batch_size])
+        for i in range(0, len(texts), args.batch_size)
+    ]
+    batch_time = time.perf_counter() - start
+    n_tokens = sum(len(ids) for ids, _ in batches)
+    print(f"[INFO] tokenize_batch: {len(texts)} lines, {n_tokens} tokens in {batch_time:.2f}s "
+          f"({len(texts) / batch_time:.0f} lines/s), trie built in {build_time:.2f}s")
+
+    try:
+        reference = load_reference_tokenizer(args.vocab_file, args.do_lower_case)
+    except ImportError as e:
+        print(f"[INFO] Skipping the FullTokenizer comparison: {e}")
+        return
+    start = time.perf_counter()
+    expected = [reference.convert_tokens_to_ids(reference.tokenize(text)) for text in texts]
+    reference_time = time.perf_counter() - start
+    print(f"[INFO] FullTokenizer: {reference_time:.2f}s ({len(texts) / reference_time:.0f} lines/s), "
+          f"speedup {reference_time / batch_time:.1f}x")
+
+    mismatches = 0
+    for b, (ids, offsets) in enumerate(batches):
+        for i in range(len(offsets) - 1):
+            if ids[offsets[i]:offsets[i + 1]].tolist() != expected[b * args.batch_size + i]:
+                mismatches += 1
+    print(f"[INFO] {mismatches} of {len(texts)} lines tokenized differently")
+
+
+if __name__ == "__main__":
+    main()
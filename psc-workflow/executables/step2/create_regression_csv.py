@@ -1,8 +1,18 @@
 import argparse
 import csv
+import hashlib
+import heapq
+import importlib.metadata
+import io
+import multiprocessing
+import multiprocessing.connection
 import os
 import random
+import sqlite3
+import time
 import warnings
+from collections import deque, namedtuple
+from functools import partial
 
 from ase.io import read
 from pymatgen.io.ase import AseAtomsAdaptor as AAA
@@ -10,24 +20,40 @@ from pymatgen.symmetry.analyzer import SpacegroupAnalyzer as SGA
 # from robocrys import StructureCondenser, StructureDescriber
 from slices.core import SLICES
 
+from pack_cifs import CifPack
+
 warnings.filterwarnings("ignore")
 
 
+# SLICES() is expensive to construct, so each process keeps one warm backend
+_slices_backend = None
+
+
 def get_slices(struct):
-    backend = SLICES()
-    slices = backend.structure2SLICES(struct)
+    global _slices_backend
+    if _slices_backend is None:
+        _slices_backend = SLICES()
+    slices = _slices_backend.structure2SLICES(struct)
     return slices
 
 
-def get_material_string(struct):
+def get_material_string(struct, symprec=0.1):
     try:
         primitive_struct = struct.get_primitive_structure()
-        spg_info = primitive_struct.get_space_group_info(symprec=0.1)
-        spg = spg_info[0]
+    except Exception as e:
+        print(f"Error processing structure: {e}")
+        return "Unknown"
+    return material_string_from_primitive(primitive_struct, symprec=symprec)
+
+
+def material_string_from_primitive(primitive_struct, symprec=0.1):
+    try:
+        # a single spglib run gives both the spacegroup symbol and the Wyckoff data
+        sga = SGA(primitive_struct, symprec=symprec)
+        spg = sga.get_space_group_symbol()
         lattice = primitive_struct.lattice
         a, b, c = lattice.abc
         alpha, beta, gamma = lattice.angles
-        sga = SGA(primitive_struct, symprec=0.1)
         symm_dict = sga.get_symmetry_dataset()
         wyckoff = symm_dict['wyckoffs']
         site_symmetry = symm_dict['site_symmetry_symbols']
@@ -52,11 +78,157 @@ def get_material_string(struct):
 # 	description = describer.describe(condensed_structure)
 # 	return description
 
-def write_tsv(training, keys, results):
+class EncodingCache:
+    """Persistent cache of CIF encodings in a single SQLite file.
+
+    Entries are keyed by the SHA-256 of the CIF contents and an encoder key
+    (see encoder_key()), so a changed file or a library upgrade is a miss.
+    Failed ("Unknown") encodings are never stored, so they are retried on
+    the next run. The default rollback journal is kept rather than WAL,
+    which needs shared memory that network filesystems such as /ocean do
+    not provide: worker processes read while the parent process is the
+    only writer, and a commit briefly blocks readers (up to the timeout).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS encodings ("
+            "cif_hash TEXT NOT NULL, encoder TEXT NOT NULL, encoding TEXT NOT NULL, "
+            "PRIMARY KEY (cif_hash, encoder))"
+        )
+        self.conn.commit()
+
+    def get(self, cif_hash, encoder):
+        row = self.conn.execute(
+            "SELECT encoding FROM encodings WHERE cif_hash = ? AND encoder = ?",
+            (cif_hash, encoder),
+        ).fetchone()
+        # failures cached by earlier versions are retried
+        return None if row is None or row[0] == "Unknown" else row[0]
+
+    def put_many(self, entries):
+        """entries: iterable of (cif_hash, encoder, encoding); failed encodings are skipped."""
+        self.conn.executemany("INSERT OR REPLACE INTO encodings VALUES (?, ?, ?)",
+                              (entry for entry in entries if entry[2] != "Unknown"))
+        self.conn.commit()
+
+    def merge_from(self, path):
+        """Copy every entry of another cache file (e.g. a shard's --cache_updates) into this one."""
+        before = self.conn.total_changes
+        self.conn.execute("ATTACH DATABASE ? AS updates", (path,))
+        self.conn.execute("INSERT OR REPLACE INTO encodings "
+                          "SELECT * FROM updates.encodings WHERE encoding != 'Unknown'")
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE updates")
+        return self.conn.total_changes - before
+
+    def close(self):
+        self.conn.close()
+
+
+# one read connection per worker process, opened on first use
+_worker_caches = {}
+
+
+def _get_cache(path):
+    if path not in _worker_caches:
+        _worker_caches[path] = EncodingCache(path)
+    return _worker_caches[path]
+
+
+# one memory map per process over a packed dataset, opened on first use
+_worker_packs = {}
+
+
+def _get_pack(path):
+    if path not in _worker_packs:
+        _worker_packs[path] = CifPack(path)
+    return _worker_packs[path]
+
+
+def library_versions():
+    versions = []
+    for dist in ('ase', 'pymatgen', 'spglib', 'slices'):
+        try:
+            versions.append(f"{dist}={importlib.metadata.version(dist)}")
+        except importlib.metadata.PackageNotFoundError:
+            versions.append(f"{dist}=unknown")
+    return ','.join(versions)
+
+
+Variant = namedtuple('Variant', ['name', 'encoding', 'symprec', 'key'])
+
+
+def encoder_key(encoding_name, symprec):
+    """Everything besides the CIF contents that the encoding depends on."""
+    if encoding_name != 'materials_string':
+        symprec = None
+    return f"{encoding_name}|symprec={symprec}|{library_versions()}"
+
+
+def make_variants(encoding_names, symprecs):
+    """Expand --encoding and --symprec into the list of datasets to produce.
+
+    materials_string yields one variant per symprec; the other encodings do
+    not depend on symprec and yield a single variant.
+    """
+    variants = []
+    for encoding_name in encoding_names:
+        if encoding_name == 'materials_string' and len(symprecs) > 1:
+            for symprec in symprecs:
+                variants.append(Variant(f"{encoding_name}_symprec{symprec}", encoding_name, symprec,
+                                        encoder_key(encoding_name, symprec)))
+        else:
+            variants.append(Variant(encoding_name, encoding_name, symprecs[0],
+                                    encoder_key(encoding_name, symprecs[0])))
+    return variants
+
+
+def encode_structure(struct, variants):
+    """Compute every variant of one structure in a single pass.
+
+    The primitive cell is found once and shared by all materials_string
+    variants, each of which runs spglib once for its own symprec.
+
+    Returns (encodings, failed). A variant whose encoder raises is left out
+    of encodings and its error put in failed, so the structure is dropped
+    from that variant only, as a single-encoding run would drop it.
+    """
+    encodings = {}
+    failed = {}
+    primitive_struct = None
+    for variant in variants:
+        try:
+            if variant.encoding == 'materials_string':
+                if primitive_struct is None:
+                    try:
+                        primitive_struct = struct.get_primitive_structure()
+                    except Exception as e:
+                        print(f"Error processing structure: {e}")
+                        primitive_struct = False
+                if primitive_struct is False:
+                    encodings[variant.name] = "Unknown"
+                else:
+                    encodings[variant.name] = material_string_from_primitive(primitive_struct,
+                                                                             symprec=variant.symprec)
+            elif variant.encoding == 'slices':
+                encodings[variant.name] = get_slices(struct)
+            else:
+                encodings[variant.name] = "Unknown"
+            # elif variant.encoding == 'robocrys':
+            # 	encodings[variant.name] = get_robocrys(struct)
+        except Exception as e:
+            failed[variant.name] = str(e)
+    return encodings, failed
+
+
+def write_tsv(training, keys, results, outdir='.'):
     if training:
-        tsv_file = 'train.tsv'
+        tsv_file = os.path.join(outdir, 'train.tsv')
     else:
-        tsv_file = 'dev.tsv'
+        tsv_file = os.path.join(outdir, 'dev.tsv')
     with open(tsv_file, 'w') as f:
         writer = csv.writer(f, delimiter='\t', lineterminator='\n')
         writer.writerow(['sentence', 'label'])
@@ -65,65 +237,563 @@ def write_tsv(training, keys, results):
     f.close()
 
 
-# print(len(keys))
+class InMemorySplitWriter:
+    """Collect every encoding, then write a seeded random.sample split on close().
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--data_dir')
-parser.add_argument('--encoding')
-parser.add_argument('--train_val_split', type=float)
-parser.add_argument('--outdir')
-parser.add_argument('--target_file', default='targets')
-args = parser.parse_args()
+    A repeated encoding keeps its first position and its last label.
+    """
 
-root_dir = os.path.abspath(args.data_dir)
-target_file = os.path.join(root_dir, '{}.csv'.format(args.target_file))
+    def __init__(self, outdir, train_val_split, seed=42):
+        self.outdir = outdir
+        self.train_val_split = train_val_split
+        self.seed = seed
+        self.results = {}
+        self.counts = {True: 0, False: 0}
+        self.duplicates = 0
 
-results = {}
+    def write(self, encoding, label):
+        if encoding in self.results:
+            self.duplicates += 1
+        self.results[encoding] = label
 
-with open(target_file, 'r') as f:
-    reader = csv.reader(f, delimiter='\t')
-    for row in reader:
-        try:
-            struct_id = row[0]
-            label = float(row[1])
+    def close(self):
+        # print(len(reader), len(results))
+        # reseeded per writer so each variant's split matches a single-encoding run
+        random.seed(self.seed)
+        total_keys = list(self.results.keys())
+        total_examples = len(total_keys)
+        train_examples = int(total_examples * self.train_val_split)
+        train_keys = random.sample(total_keys, train_examples)
+        train_key_set = set(train_keys)
+        val_keys = [key for key in total_keys if key not in train_key_set]
+
+        write_tsv(True, train_keys, self.results, self.outdir)
+        write_tsv(False, val_keys, self.results, self.outdir)
+        self.counts = {True: len(train_keys), False: len(val_keys)}
+
+
+class StreamingSplitWriter:
+    """Write train.tsv/dev.tsv row by row as encodings are produced.
+
+    Each encoding goes to train when a keyed 64-bit hash of it, read as a
+    fraction of 2**64, is below train_val_split. The assignment depends only
+    on the encoding and the seed, so it is the same for any row order or
+    worker count. Exact duplicates are dropped by keeping the 8-byte digests
+    seen so far; unlike the in-memory split, the first label wins.
+    """
+
+    def __init__(self, outdir, train_val_split, seed=42):
+        self.train_val_split = train_val_split
+        self.key = str(seed).encode()
+        self.seen = set()
+        self.counts = {True: 0, False: 0}
+        self.duplicates = 0
+        self.files = {}
+        self.writers = {}
+        for training, tsv_file in ((True, 'train.tsv'), (False, 'dev.tsv')):
+            f = open(os.path.join(outdir, tsv_file), 'w')
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(['sentence', 'label'])
+            self.files[training] = f
+            self.writers[training] = writer
+
+    def write(self, encoding, label):
+        digest = hashlib.blake2b(encoding.encode(), digest_size=8, key=self.key).digest()
+        if digest in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(digest)
+        training = int.from_bytes(digest, 'big') / 2 ** 64 < self.train_val_split
+        self.writers[training].writerow([encoding, label])
+        self.counts[training] += 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+class ShardWriter:
+    """Write a shard's encodings, in input order and unsplit, for a later --merge_shards run."""
+
+    def __init__(self, outdir):
+        self.f = open(os.path.join(outdir, SHARD_FILE), 'w')
+        self.writer = csv.writer(self.f, delimiter='\t', lineterminator='\n')
+        self.writer.writerow(['sentence', 'label'])
+        self.rows = 0
+
+    def write(self, encoding, label):
+        self.writer.writerow([encoding, label])
+        self.rows += 1
+
+    def close(self):
+        self.f.close()
+
+
+SHARD_FILE = 'encodings.tsv'
+
+
+def shard_bounds(num_rows, shard_index, num_shards):
+    """Contiguous [start, end) row range of one shard.
+
+    Shards are contiguous so that concatenating them in shard order gives
+    back the original row order, and the merged split matches a single run.
+    """
+    return num_rows * shard_index // num_shards, num_rows * (shard_index + 1) // num_shards
+
+
+def read_shard(shard_dir):
+    """Yield (encoding, label) from a shard written by ShardWriter."""
+    with open(os.path.join(shard_dir, SHARD_FILE), 'r') as f:
+        reader = csv.reader(f, delimiter='\t')
+        next(reader)
+        for encoding, label in reader:
+            yield encoding, float(label)
+
+
+class TimingLog:
+    """Stream per-structure timings to a TSV and keep the slowest n in a heap."""
+
+    def __init__(self, path, n_slowest=10):
+        self.path = path
+        self.n_slowest = n_slowest
+        self.slowest = []
+        self.f = open(path, 'w')
+        self.writer = csv.writer(self.f, delimiter='\t', lineterminator='\n')
+        self.writer.writerow(['struct_id', 'seconds', 'status'])
+
+    def add(self, struct_id, seconds, status):
+        self.writer.writerow([struct_id, f"{seconds:.4f}", status])
+        if self.n_slowest > 0:
+            entry = (seconds, struct_id, status)
+            if len(self.slowest) < self.n_slowest:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def close(self):
+        self.f.close()
+        return sorted(self.slowest, reverse=True)
+
+
+FeaturizeResult = namedtuple('FeaturizeResult', ['struct_id', 'encodings', 'label', 'error', 'cif_hash', 'cached',
+                                                 'seconds', 'timed_out', 'failed'])
+
+
+def featurize(row, root_dir, variants, cache_path=None, packed=False):
+    """Parse one row of the targets file and encode its CIF into every variant.
+
+    root_dir is either a directory of <struct_id>.cif files or, with packed
+    set, a .cifpack file written by pack_cifs.py.
+
+    Returns a FeaturizeResult whose encodings map variant name to encoding
+    and whose cached set names the variants served from the cache; error is
+    None unless the whole structure failed, and failed maps the variants
+    that could not be encoded to their errors. Runs in worker processes,
+    so apart from its read-only cache connection and warm backends it must
+    not touch any global state.
+    """
+    start = time.perf_counter()
+    result = _featurize(row, root_dir, variants, cache_path, packed)
+    return result._replace(seconds=time.perf_counter() - start)
+
+
+def _featurize(row, root_dir, variants, cache_path, packed):
+    struct_id = row[0] if row else ""
+    try:
+        label = float(row[1])
+        if packed:
+            pack = _get_pack(root_dir)
+            found = struct_id in pack
+        else:
             cif_path = os.path.join(root_dir, f"{struct_id}.cif")
+            found = os.path.exists(cif_path)
 
-            if not os.path.exists(cif_path):
-                print(f"[{struct_id}] SKIPPED: CIF not found")
-                continue
+        if not found:
+            return FeaturizeResult(struct_id, None, None, "CIF not found", None, set(), None, False, {})
 
-            s = read(cif_path, index=0)
-            pym_struct = AAA.get_structure(s)
+        cif_hash = None
+        encodings = {}
+        if cache_path is not None:
+            if packed:
+                cif_bytes = pack.read_bytes(struct_id)
+            else:
+                with open(cif_path, 'rb') as f:
+                    cif_bytes = f.read()
+            cif_hash = hashlib.sha256(cif_bytes).hexdigest()
+            cache = _get_cache(cache_path)
+            for variant in variants:
+                encoding = cache.get(cif_hash, variant.key)
+                if encoding is not None:
+                    encodings[variant.name] = encoding
+        cached = set(encodings)
 
-            if args.encoding == 'materials_string':
-                encoding = get_material_string(pym_struct)
-            elif args.encoding == 'slices':
-                encoding = get_slices(pym_struct)
+        missing = [variant for variant in variants if variant.name not in cached]
+        failed = {}
+        if missing:
+            if packed:
+                s = read(io.StringIO(pack[struct_id]), format='cif', index=0)
             else:
-                encoding = "Unknown"
-            # elif args.encoding == 'robocrys':
-            # 	encoding = get_robocrys(pym_struct)
-            results[encoding] = label
-        except Exception as e:
-            print(f"[{struct_id}] SKIPPED: {e}")
+                s = read(cif_path, index=0)
+            pym_struct = AAA.get_structure(s)
+            new_encodings, failed = encode_structure(pym_struct, missing)
+            encodings.update(new_encodings)
+        return FeaturizeResult(struct_id, encodings, label, None, cif_hash, cached, None, False, failed)
+    except Exception as e:
+        return FeaturizeResult(struct_id, None, None, str(e), None, set(), None, False, {})
+
+
+def _budgeted_worker(conn, featurize_fn):
+    """Worker loop of featurize_budgeted: featurize (row, variants) tasks from conn until None arrives."""
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        row, variants = task
+        conn.send(featurize_fn(row, variants=variants))
+
+
+class _BudgetedWorker:
+    """One featurization process and the task it is running, if any."""
+
+    def __init__(self, featurize_fn):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_budgeted_worker, args=(child_conn, featurize_fn),
+                                               daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+    def submit(self, task):
+        position, row, variants = task
+        self.task = task
+        self.started = time.perf_counter()
+        self.conn.send((row, variants))
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join()
+        self.conn.close()
+
+
+def merge_variant_results(results, variants):
+    """Combine the single-variant results of one structure into one FeaturizeResult."""
+    encodings, failed, cached = {}, {}, set()
+    label = cif_hash = None
+    for variant, result in zip(variants, results):
+        if result.error is not None:
+            failed[variant.name] = result.error
+            continue
+        encodings.update(result.encodings)
+        failed.update(result.failed)
+        cached |= result.cached
+        label = result.label
+        cif_hash = cif_hash or result.cif_hash
+    seconds = sum(result.seconds for result in results)
+    timed_out = any(result.timed_out for result in results)
+    if not encodings and not any(result.error is None for result in results):
+        error = "; ".join(f"{name}: {message}" for name, message in failed.items())
+        return FeaturizeResult(results[0].struct_id, None, None, error, None, set(), seconds, timed_out, {})
+    return FeaturizeResult(results[0].struct_id, encodings, label, None, cif_hash, cached, seconds, timed_out,
+                           failed)
+
+
+def featurize_budgeted(rows, featurize_fn, variants, workers, time_limit):
+    """Yield featurize_fn results for rows, in order, with a time limit per structure.
+
+    Every structure runs in a worker process that is killed and replaced
+    once it passes time_limit seconds. Killing the process also stops a
+    structure stuck in a single C call, such as spglib or
+    structure2SLICES, which no signal handler can interrupt. A worker that
+    crashes is replaced the same way. When a structure with several
+    variants runs out of time, each variant is retried on its own with a
+    full budget, so only the variants that are slow by themselves are
+    dropped, as they would be in single-encoding runs.
+    """
+    tasks = deque((position, row, variants) for position, row in enumerate(rows))
+    retries = {}
+    done = {}
+    next_position = 0
+    idle = [_BudgetedWorker(featurize_fn) for _ in range(max(1, workers))]
+    busy = []
+
+    def finish(task, result):
+        position, row, task_variants = task
+        if position in retries:
+            pieces, first_attempt_seconds = retries[position]
+            pieces[task_variants[0].name] = result
+            if len(pieces) == len(variants):
+                del retries[position]
+                merged = merge_variant_results([pieces[variant.name] for variant in variants], variants)
+                done[position] = merged._replace(seconds=merged.seconds + first_attempt_seconds)
+        elif result.timed_out and len(task_variants) > 1:
+            retries[position] = ({}, result.seconds)
+            for variant in reversed(task_variants):
+                tasks.appendleft((position, row, [variant]))
+        else:
+            done[position] = result
+
+    try:
+        while tasks or busy:
+            while tasks and idle:
+                worker = idle.pop()
+                worker.submit(tasks.popleft())
+                busy.append(worker)
+            wait = max(0., min(worker.started for worker in busy) + time_limit - time.perf_counter())
+            ready = multiprocessing.connection.wait([worker.conn for worker in busy], timeout=wait)
+            now = time.perf_counter()
+            for worker in list(busy):
+                if worker.conn in ready:
+                    try:
+                        result = worker.conn.recv()
+                    except EOFError:
+                        result = None
+                        error, timed_out = "worker process died", False
+                elif now - worker.started >= time_limit:
+                    result = None
+                    error, timed_out = f"exceeded time budget of {time_limit}s", True
+                else:
+                    continue
+                busy.remove(worker)
+                task = worker.task
+                if result is None:
+                    row = task[1]
+                    result = FeaturizeResult(row[0] if row else "", None, None, error, None, set(),
+                                             now - worker.started, timed_out, {})
+                    worker.stop(kill=True)
+                    worker = _BudgetedWorker(featurize_fn)
+                idle.append(worker)
+                finish(task, result)
+            while next_position in done:
+                yield done.pop(next_position)
+                next_position += 1
+    finally:
+        for worker in idle:
+            worker.stop()
+        for worker in busy:
+            worker.stop(kill=True)
+
+
+def featurize_rows(rows, root_dir, variants, cache_path=None, time_limit=None, packed=False,
+                   workers=1, chunksize=None):
+    """Yield featurize() results for rows, in the same order as rows.
+
+    With workers > 1 the rows are dispatched in chunks to a process pool;
+    imap keeps the output ordered so the split is identical to a serial run.
+    With a time_limit, rows go one at a time to killable worker processes
+    instead (see featurize_budgeted), also when workers is 1.
+    """
+    if time_limit:
+        featurize_fn = partial(featurize, root_dir=root_dir, cache_path=cache_path, packed=packed)
+        yield from featurize_budgeted(rows, featurize_fn, variants, workers, time_limit)
+        return
+
+    featurize_fn = partial(featurize, root_dir=root_dir, variants=variants, cache_path=cache_path, packed=packed)
+    if workers <= 1:
+        yield from map(featurize_fn, rows)
+        return
+
+    if chunksize is None:
+        # a few chunks per worker balances load without flooding the pipe
+        chunksize = max(1, len(rows) // (workers * 4))
+    with multiprocessing.Pool(processes=workers) as pool:
+        yield from pool.imap(featurize_fn, rows, chunksize=chunksize)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir',
+                        help="directory of CIFs and targets file, or a .cifpack file from pack_cifs.py")
+    parser.add_argument('--encoding', nargs='+',
+                        help="one or more of materials_string, slices; all are computed in one pass")
+    parser.add_argument('--train_val_split', type=float)
+    parser.add_argument('--outdir',
+                        help="output directory; with several variants each gets its own subdirectory")
+    parser.add_argument('--target_file', default='targets')
+    parser.add_argument('--symprec', type=float, nargs='+', default=[0.1],
+                        help="symmetry tolerance(s) for the materials_string encoding")
+    parser.add_argument('--cache', default=None,
+                        help="SQLite file caching encodings by CIF content hash; disabled if unset")
+    parser.add_argument('--cache_updates', default=None,
+                        help="write new encodings to this SQLite file and only read --cache, so that "
+                             "shard jobs on several nodes can share one cache; fold it back in with "
+                             "--merge_cache_updates")
+    parser.add_argument('--merge_cache_updates', nargs='+', default=None,
+                        help="--cache_updates files to merge into --cache")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of featurization processes; 1 runs serially")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="rows handed to a worker at a time; defaults to rows / (4 * workers)")
+    parser.add_argument('--time_budget', type=float, default=None,
+                        help="seconds allowed per structure before it is skipped; unlimited if unset")
+    parser.add_argument('--timing_log', default=None,
+                        help="per-structure timing TSV; defaults to <outdir>/featurize_timing.tsv")
+    parser.add_argument('--report_slowest', type=int, default=10,
+                        help="number of slowest structures to list at the end of the run")
+    parser.add_argument('--streaming', action='store_true',
+                        help="write rows as they are produced and split them by hash instead of "
+                             "holding the whole dataset in memory")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="seed for the train/dev split")
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help="featurize only one of this many contiguous slices of the targets file "
+                             "and write its unsplit encodings for a later --merge_shards run")
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help="which slice to featurize when --num_shards > 1")
+    parser.add_argument('--merge_shards', nargs='+', default=None,
+                        help="shard output directories, in shard order, to merge and split "
+                             "instead of featurizing; --data_dir is not used")
+    args = parser.parse_args()
+    if (args.cache_updates or args.merge_cache_updates) and not args.cache:
+        parser.error("--cache_updates and --merge_cache_updates need --cache")
+    return args
+
+
+def featurize_dataset(args, variants, writers):
+    """Featurize the (shard of the) dataset and feed each encoding to writers[variant.name]."""
+    root_dir = os.path.abspath(args.data_dir)
+    outdir = os.path.abspath(args.outdir)
+
+    packed = os.path.isfile(root_dir)
+    if packed:
+        pack = CifPack(root_dir)
+        rows = pack.target_rows(args.target_file)
+        pack.close()
+    else:
+        target_file = os.path.join(root_dir, '{}.csv'.format(args.target_file))
+        with open(target_file, 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+
+    if args.num_shards > 1:
+        start, end = shard_bounds(len(rows), args.shard_index, args.num_shards)
+        print(f"[INFO] Shard {args.shard_index + 1}/{args.num_shards}: rows {start} to {end - 1}")
+        rows = rows[start:end]
+
+    # created up front so workers only ever open an existing database
+    cache_path = os.path.abspath(args.cache) if args.cache else None
+    cache = None
+    if cache_path:
+        EncodingCache(cache_path).close()
+        # workers read cache_path; new encodings go to the updates file if there is one
+        cache = EncodingCache(os.path.abspath(args.cache_updates) if args.cache_updates else cache_path)
+    pending = []
+    hits = misses = 0
+
+    timing_log = TimingLog(os.path.abspath(args.timing_log) if args.timing_log
+                           else os.path.join(outdir, 'featurize_timing.tsv'), args.report_slowest)
+    timed_out = []
+
+    for result in featurize_rows(rows, root_dir, variants, cache_path=cache_path,
+                                 time_limit=args.time_budget, packed=packed, workers=args.workers,
+                                 chunksize=args.chunksize):
+        if result.timed_out:
+            timed_out.append(result.struct_id)
+        if result.error is not None:
+            print(f"[{result.struct_id}] SKIPPED: {result.error}")
+            timing_log.add(result.struct_id, result.seconds, 'timeout' if result.timed_out else 'skipped')
+            continue
+        if result.failed:
+            status = 'partial_timeout' if result.timed_out else 'partial'
+        elif len(result.cached) == len(variants):
+            status = 'cached'
+        else:
+            status = 'ok'
+        timing_log.add(result.struct_id, result.seconds, status)
+        for variant in variants:
+            if variant.name in result.failed:
+                print(f"[{result.struct_id}] SKIPPED for {variant.name}: {result.failed[variant.name]}")
+                continue
+            encoding = result.encodings[variant.name]
+            if cache is not None:
+                if variant.name in result.cached:
+                    hits += 1
+                else:
+                    misses += 1
+                    pending.append((result.cif_hash, variant.key, encoding))
+            writers[variant.name].write(encoding, result.label)
+        if len(pending) >= 1000:
+            cache.put_many(pending)
+            pending = []
+
+    if cache is not None:
+        cache.put_many(pending)
+        cache.close()
+    slowest = timing_log.close()
+
+    print(f"[INFO] Timing log: {timing_log.path}")
+    if slowest:
+        print(f"[INFO] Slowest {len(slowest)} structures:")
+        for seconds, struct_id, status in slowest:
+            print(f"    {struct_id}\t{seconds:.2f}s\t{status}")
+    if timed_out:
+        print(f"[INFO] {len(timed_out)} structures exceeded the {args.time_budget}s budget: {' '.join(timed_out)}")
+    if cache is not None:
+        print(f"[INFO] Encoding cache: {hits} hits | {misses} misses ({cache_path})")
+        if args.cache_updates:
+            print(f"[INFO] New encodings written to {os.path.abspath(args.cache_updates)}")
+
+
+def main():
+    args = parse_args()
+
+    outdir = os.path.abspath(args.outdir)
+    variants = make_variants(args.encoding, args.symprec)
+    variant_dirs = {}
+    for variant in variants:
+        variant_dirs[variant.name] = outdir if len(variants) == 1 else os.path.join(outdir, variant.name)
+        os.makedirs(variant_dirs[variant.name], exist_ok=True)
+
+    sharded = args.num_shards > 1
+    writers = {}
+    for variant in variants:
+        variant_dir = variant_dirs[variant.name]
+        if sharded:
+            writers[variant.name] = ShardWriter(variant_dir)
+        elif args.streaming:
+            writers[variant.name] = StreamingSplitWriter(variant_dir, args.train_val_split, seed=args.seed)
+        else:
+            writers[variant.name] = InMemorySplitWriter(variant_dir, args.train_val_split, seed=args.seed)
+
+    if args.merge_shards:
+        for shard_dir in args.merge_shards:
+            for variant in variants:
+                shard_variant_dir = shard_dir if len(variants) == 1 else os.path.join(shard_dir, variant.name)
+                for encoding, label in read_shard(shard_variant_dir):
+                    writers[variant.name].write(encoding, label)
+        print(f"[INFO] Merged {len(args.merge_shards)} shards")
+        if args.merge_cache_updates:
+            cache = EncodingCache(os.path.abspath(args.cache))
+            for updates_path in args.merge_cache_updates:
+                print(f"[INFO] Merged {cache.merge_from(os.path.abspath(updates_path))} encodings "
+                      f"from {updates_path} into {args.cache}")
+            cache.close()
+    else:
+        featurize_dataset(args, variants, writers)
+
+    for variant in variants:
+        writer = writers[variant.name]
+        writer.close()
+
+        # -------------------------------
+        # Added completion prints for Slurm
+        # -------------------------------
+        print(f"[INFO] Output directory: {variant_dirs[variant.name]}")
+        if sharded:
+            print(f"[INFO] Shard rows: {writer.rows}")
             continue
+        if writer.duplicates:
+            print(f"[INFO] {variant.name}: dropped {writer.duplicates} duplicate encodings")
+        n_train, n_val = writer.counts[True], writer.counts[False]
+        print(f"[INFO] Train rows: {n_train} | Dev rows: {n_val} | Total: {n_train + n_val}")
+
+    print("[DONE] TSV generation complete. Job finished successfully.")
+
 
-# print(len(reader), len(results))
-random.seed(42)
-total_keys = list(results.keys())
-total_examples = len(total_keys)
-train_examples = int(total_examples * args.train_val_split)
-train_keys = random.sample(total_keys, train_examples)
-val_keys = [key for key in total_keys if key not in train_keys]
-
-os.chdir(args.outdir)
-
-write_tsv(True, train_keys, results)
-write_tsv(False, val_keys, results)
-
-# -------------------------------
-# Added completion prints for Slurm
-# -------------------------------
-print(f"[INFO] Output directory: {os.path.abspath(args.outdir)}")
-print(f"[INFO] Train rows: {len(train_keys)} | Dev rows: {len(val_keys)} | Total: {total_examples}")
-print("[DONE] TSV generation complete. Job finished successfully.")
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,8 @@
 
 ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
 
-tar xvzf merged_dataset_ocelot.tgz
+mkdir -p ${ENTRY_LOCATION}/cache
 
-python3 create_regression_csv.py --data_dir Merged_Dataset/OCELOT --encoding materials_string --outdir regression_OCELOT/ms_OCELOT --train_val_split 0.8
+python3 create_regression_csv.py --data_dir merged_dataset_ocelot.cifpack --encoding materials_string --outdir regression_OCELOT/ms_OCELOT --train_val_split 0.8 --workers ${SLURM_CPUS_PER_TASK:-1} --cache ${ENTRY_LOCATION}/cache/regression_encodings.sqlite --time_budget 300
 
 tar cvzf ${ENTRY_LOCATION}/regression_OCELOT__ms_OCELOT.tgz --directory=${ENTRY_LOCATION}/ regression_OCELOT/ms_OCELOT
\ No newline at end of file
@@ -0,0 +1,20 @@
+#!/usr/bin/env bash
+#SBATCH -t 0:10:00
+
+# Featurizes one contiguous shard of the OCELOT dataset.
+# Usage: create_regression_csv_shard.sh SHARD_INDEX NUM_SHARDS [WORKERS]
+# The walltime matches FEATURIZE_JOB_RUNTIME and WORKERS FEATURIZE_CPUS_PER_JOB in main.py.
+
+ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
+SHARD_INDEX=$1
+NUM_SHARDS=$2
+WORKERS=${3:-${SLURM_CPUS_PER_TASK:-1}}
+
+# every shard reads the shared cache, which is keyed per structure; SQLite cannot take writers
+# from several nodes at once, so new encodings go to a per-shard updates file that
+# merge_regression_csv.sh folds back into the shared cache
+mkdir -p ${ENTRY_LOCATION}/cache
+
+python3 create_regression_csv.py --data_dir merged_dataset_ocelot.cifpack --encoding materials_string --outdir regression_OCELOT/ms_OCELOT_shard_${SHARD_INDEX} --num_shards ${NUM_SHARDS} --shard_index ${SHARD_INDEX} --workers ${WORKERS} --cache ${ENTRY_LOCATION}/cache/regression_encodings.sqlite --cache_updates ${ENTRY_LOCATION}/cache/regression_encodings.updates_${SHARD_INDEX}_of_${NUM_SHARDS}.sqlite --time_budget 300
+
+tar cvzf regression_OCELOT__ms_OCELOT__shard_${SHARD_INDEX}.tgz regression_OCELOT/ms_OCELOT_shard_${SHARD_INDEX}
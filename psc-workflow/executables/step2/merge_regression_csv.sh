@@ -0,0 +1,27 @@
+#!/usr/bin/env bash
+#SBATCH -t 0:30:00
+
+# Merges the outputs of create_regression_csv_shard.sh into the final train/dev split.
+# Usage: merge_regression_csv.sh NUM_SHARDS
+
+ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
+NUM_SHARDS=$1
+
+SHARD_DIRS=""
+for (( SHARD_INDEX=0; SHARD_INDEX<NUM_SHARDS; SHARD_INDEX++ )); do
+    tar xvzf regression_OCELOT__ms_OCELOT__shard_${SHARD_INDEX}.tgz
+    SHARD_DIRS="${SHARD_DIRS} regression_OCELOT/ms_OCELOT_shard_${SHARD_INDEX}"
+done
+
+# fold the shards' new encodings into the shared cache
+CACHE_UPDATES=""
+for (( SHARD_INDEX=0; SHARD_INDEX<NUM_SHARDS; SHARD_INDEX++ )); do
+    UPDATES_FILE=${ENTRY_LOCATION}/cache/regression_encodings.updates_${SHARD_INDEX}_of_${NUM_SHARDS}.sqlite
+    if [ -f ${UPDATES_FILE} ]; then
+        CACHE_UPDATES="${CACHE_UPDATES} ${UPDATES_FILE}"
+    fi
+done
+
+python3 create_regression_csv.py --merge_shards ${SHARD_DIRS} --encoding materials_string --outdir regression_OCELOT/ms_OCELOT --train_val_split 0.8 ${CACHE_UPDATES:+--cache ${ENTRY_LOCATION}/cache/regression_encodings.sqlite --merge_cache_updates ${CACHE_UPDATES}} && rm -f ${CACHE_UPDATES}
+
+tar cvzf ${ENTRY_LOCATION}/regression_OCELOT__ms_OCELOT.tgz --directory=${ENTRY_LOCATION}/ regression_OCELOT/ms_OCELOT
@@ -0,0 +1,110 @@
+"""
+Pack a directory of CIF files and its targets file into a single indexed file.
+
+Layout of a .cifpack file:
+
+    MAGIC | record | record | ... | index (JSON) | index offset (u64) | index length (u64) | MAGIC
+
+Records are the raw CIF bytes, back to back. The index maps each structure
+id to the (offset, length) of its record and also carries the text of the
+targets file(s), so a job only has to stage this one file. CifPack reads
+records straight out of a memory map without extracting anything.
+"""
+import argparse
+import csv
+import io
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b"CIFPACK1"
+TRAILER = struct.Struct("<QQ")
+
+
+class CifPack:
+    """Memory-mapped reader for a .cifpack file.
+
+    Supports len(), ``struct_id in pack``, pack[struct_id] (CIF text) and
+    iteration over the structure ids in the order they were packed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._mmap)
+        trailer_start = size - TRAILER.size - len(MAGIC)
+        if self._mmap[:len(MAGIC)] != MAGIC or self._mmap[size - len(MAGIC):] != MAGIC:
+            raise ValueError(f"{path} is not a cifpack file")
+        index_offset, index_length = TRAILER.unpack_from(self._mmap, trailer_start)
+        index = json.loads(self._mmap[index_offset:index_offset + index_length])
+        self.target_files = index['target_files']
+        self._ids = [entry[0] for entry in index['entries']]
+        self._entries = {entry[0]: (entry[1], entry[2]) for entry in index['entries']}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, struct_id):
+        return struct_id in self._entries
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def read_bytes(self, struct_id):
+        offset, length = self._entries[struct_id]
+        return self._mmap[offset:offset + length]
+
+    def __getitem__(self, struct_id):
+        return self.read_bytes(struct_id).decode()
+
+    def target_rows(self, target_file='targets'):
+        """Rows of the packed targets file, as csv.reader would give them."""
+        return list(csv.reader(io.StringIO(self.target_files[target_file]), delimiter='\t'))
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def pack_directory(data_dir, outfile, target_files=('targets',)):
+    """Write every *.cif in data_dir plus the named targets files to outfile."""
+    cif_names = sorted(name for name in os.listdir(data_dir) if name.endswith('.cif'))
+    entries = []
+    with open(outfile, 'wb') as out:
+        out.write(MAGIC)
+        for name in cif_names:
+            with open(os.path.join(data_dir, name), 'rb') as f:
+                data = f.read()
+            entries.append([name[:-len('.cif')], out.tell(), len(data)])
+            out.write(data)
+
+        targets = {}
+        for target_file in target_files:
+            with open(os.path.join(data_dir, f"{target_file}.csv"), 'r') as f:
+                targets[target_file] = f.read()
+
+        index = json.dumps({'target_files': targets, 'entries': entries}).encode()
+        index_offset = out.tell()
+        out.write(index)
+        out.write(TRAILER.pack(index_offset, len(index)))
+        out.write(MAGIC)
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', required=True, help="directory holding the CIFs and targets file")
+    parser.add_argument('--outfile', required=True, help="path of the .cifpack file to write")
+    parser.add_argument('--target_file', nargs='+', default=['targets'],
+                        help="name(s) of the targets file(s) in data_dir, without .csv")
+    args = parser.parse_args()
+
+    n_cifs = pack_directory(args.data_dir, args.outfile, args.target_file)
+    print(f"[INFO] Packed {n_cifs} CIFs into {os.path.abspath(args.outfile)} "
+          f"({os.path.getsize(args.outfile) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@
 
 ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
 
-tar xvzf merged_dataset_ocelot.tgz
 tar xvzf pretrain_OCELOT__pretrain_MS_0_0001__model_pretrain.tgz
 
 # TODO: Run the "create_regression_csv.py" and "run_roberta.py" steps before running this one. The dirs mentioned in the YAML require on that step finishing.
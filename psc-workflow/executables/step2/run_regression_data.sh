@@ -2,6 +2,7 @@
 #SBATCH -p RM-shared
 #SBATCH -N 1
 #SBATCH -n 1
+#SBATCH --cpus-per-task=28
 #SBATCH -t 5:00:00
 #SBATCH -J RegressionData
 #SBATCH -A sys890003p
@@ -15,4 +16,5 @@ conda activate /jet/home/spagaria/.conda/envs/shreya
 # while running robocrys use the following conda environment
 # conda activate /jet/home/spagaria/.conda/envs/shreya
 
-python3 create_regression_csv.py --data_dir /ocean/projects/sys890003p/spagaria/project1/dana/Merged_Dataset/OCELOT --encoding materials_string --outdir /ocean/projects/sys890003p/spagaria/project1/dana/regression_OCELOT/ms_OCELOT --train_val_split 0.8
\ No newline at end of file
+mkdir -p /ocean/projects/sys890003p/spagaria/project1/dana/cache
+python3 create_regression_csv.py --data_dir /ocean/projects/sys890003p/spagaria/project1/dana/Merged_Dataset/OCELOT --encoding materials_string --outdir /ocean/projects/sys890003p/spagaria/project1/dana/regression_OCELOT/ms_OCELOT --train_val_split 0.8 --workers ${SLURM_CPUS_PER_TASK:-1} --cache /ocean/projects/sys890003p/spagaria/project1/dana/cache/regression_encodings.sqlite --time_budget 300
\ No newline at end of file
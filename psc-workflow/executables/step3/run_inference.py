@@ -4,9 +4,23 @@ import sys
 # replace this with your modelzoo path
 MODELZOO_PATH = os.getenv(key='MODELZOO_PATH', default='/ocean/neocortex/cerebras/modelzoo')
 sys.path.append(MODELZOO_PATH)
+# wordpiece.py lives with the step-1 scripts
+STEP1_PATH = os.getenv(key='STEP1_PATH',
+                       default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'step1'))
+sys.path.append(STEP1_PATH)
 
 import argparse
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import glob
+import hashlib
 import json
+import math
+import pickle
+import re
+import time
 from modelzoo.transformers.pytorch.huggingface_common.modeling_bert import BertForSequenceClassification, BertConfig
 from modelzoo.transformers.pytorch.bert.fine_tuning.classifier.input.BertClassifierDataProcessor import SST2Dataset
 import numpy as np
@@ -16,47 +30,498 @@ from tqdm import tqdm
 import yaml
 
 
-def get_mae(arr1, arr2):
-    diff = np.abs(np.subtract(arr1, arr2))
-    mae = np.sum(diff)
-    mae /= diff.shape[0]
-    print("MAE:", mae)
-    return mae
-
-
-def get_rsquared(arr1, arr2):
-    arr_bar = np.mean(arr1)
-    ss_tot = ((arr1 - arr_bar) ** 2).sum()
-    ss_res = ((arr1 - arr2) ** 2).sum()
-    return 1 - (ss_res / ss_tot)
-
-
-def run_model(model, dataloader):
-    count = 0
-    running_loss = 0.
-    preds = []
-    true = []
-
-    with torch.no_grad():
-        for i, data in tqdm(enumerate(dataloader)):
-            outputs = model(data['input_ids'])
-            labels = data['labels']
-            logits = outputs.logits.squeeze()
-            preds.extend(logits.tolist())
-            true.extend(labels.tolist())
-            loss = loss_fn(logits, labels)
-            loss *= data['labels'].size(0)
-            count += data['labels'].size(0)
-            running_loss += loss
-        running_loss /= count
-        print("RUNNING LOSS:", running_loss)
-
-    values = {'preds': preds, 'labels': true}
+class RegressionMetrics:
+    """Running MAE, MSE and R^2 kept as float64 sums on the device; compute() syncs once."""
+
+    def __init__(self, device):
+        # counted on the host, from the batch shapes
+        self.count = 0
+        # sum |error|, sum error^2, sum (label - shift), sum (label - shift)^2
+        self.sums = torch.zeros(4, dtype=torch.float64, device=device)
+        # the first batch's label mean, so that the R^2 denominator
+        # sum(y^2) - sum(y)^2 / n does not cancel catastrophically
+        self.shift = None
+
+    def update(self, preds, labels):
+        preds = preds.double()
+        labels = labels.double()
+        if self.shift is None:
+            self.shift = labels.mean()
+        error = preds - labels
+        centered = labels - self.shift
+        self.count += labels.numel()
+        self.sums += torch.stack([
+            error.abs().sum(),
+            (error ** 2).sum(),
+            centered.sum(),
+            (centered ** 2).sum(),
+        ])
+
+    def compute(self):
+        count = self.count
+        abs_error, squared_error, label_sum, label_square_sum = self.sums.tolist()
+        ss_tot = label_square_sum - label_sum ** 2 / count
+        return {
+            "mae": abs_error / count,
+            "mse": squared_error / count,
+            "r2": 1 - squared_error / ss_tot,
+        }
+
+
+def autocast_context(enabled):
+    """bf16 autocast on CPU, fp16 on CUDA; a no-op when not enabled."""
+    if not enabled:
+        return contextlib.nullcontext()
+    dtype = torch.float16 if device == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device, dtype=dtype)
+
+
+class WordPieceRegressionDataset(torch.utils.data.Dataset):
+    """SST2Dataset's features for dev.tsv, tokenized in one tokenize_batch call."""
+
+    def __init__(self, params, is_training=False):
+        from wordpiece import WordPieceTokenizer
+
+        tsv_file = os.path.join(params['data_dir'], 'train.tsv' if is_training else 'dev.tsv')
+        with open(tsv_file, 'r') as f:
+            rows = list(csv.DictReader(f, delimiter='\t'))
+        tokenizer = WordPieceTokenizer(params['vocab_file'], params.get('do_lower', False))
+        self.ids, self.offsets = tokenizer.tokenize_batch(row['sentence'] for row in rows)
+        self.labels = np.asarray([float(row['label']) for row in rows], dtype=np.float32)
+        self.max_sequence_length = params['max_sequence_length']
+        self.cls_id = tokenizer.vocab['[CLS]']
+        self.sep_id = tokenizer.vocab['[SEP]']
+        self.pad_id = tokenizer.vocab.get('[PAD]', 0)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        msl = self.max_sequence_length
+        ids = self.ids[self.offsets[index]:self.offsets[index + 1]][:msl - 2]
+        input_ids = np.full(msl, self.pad_id, dtype=np.int32)
+        input_ids[0] = self.cls_id
+        input_ids[1:len(ids) + 1] = ids
+        input_ids[len(ids) + 1] = self.sep_id
+        attention_mask = np.zeros(msl, dtype=np.int32)
+        attention_mask[:len(ids) + 2] = 1
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'token_type_ids': np.zeros(msl, dtype=np.int32),
+            'labels': self.labels[index],
+        }
+
+
+CACHED_ARRAYS = ('input_ids', 'attention_mask', 'labels')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def eval_set_key(params, tokenizer_name, is_training=False):
+    """Everything that decides the tokenized eval set: TSV and vocab contents and tokenizer settings."""
+    tsv_file = os.path.join(params['data_dir'], 'train.tsv' if is_training else 'dev.tsv')
+    return {
+        'tsv': file_sha256(tsv_file),
+        'vocab': file_sha256(params['vocab_file']),
+        'max_sequence_length': params['max_sequence_length'],
+        'do_lower': params.get('do_lower', False),
+        'tokenizer': tokenizer_name,
+    }
+
+
+class CachedTokenizedDataset(torch.utils.data.Dataset):
+    """
+    input_ids, attention_mask and labels of the eval set, stored as .npy
+    files in cache_dir and read back through memory maps.
+
+    The cache key covers the TSV and vocab file contents, the sequence
+    length, do_lower and the tokenizer, so a change to any of them builds a
+    new entry by running build_dataset() once.
+    """
+
+    def __init__(self, params, cache_dir, build_dataset, tokenizer_name, is_training=False):
+        key = hashlib.sha256(json.dumps(
+            eval_set_key(params, tokenizer_name, is_training), sort_keys=True
+        ).encode()).hexdigest()[:32]
+        prefix = os.path.join(cache_dir, f"eval_{key}")
+        self.cache_hit = all(os.path.exists(f"{prefix}.{name}.npy") for name in CACHED_ARRAYS)
+        if not self.cache_hit:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._build(prefix, build_dataset())
+        self.arrays = {name: np.load(f"{prefix}.{name}.npy", mmap_mode='r') for name in CACHED_ARRAYS}
+        print(f"[INFO] Tokenized eval set {'read from' if self.cache_hit else 'cached in'} {prefix}.*.npy")
+
+    @staticmethod
+    def _build(prefix, dataset):
+        items = [dataset[i] for i in range(len(dataset))]
+        for name in CACHED_ARRAYS:
+            dtype = np.float32 if name == 'labels' else np.int32
+            array = np.stack([np.asarray(item[name], dtype=dtype) for item in items])
+            # written under a temporary name so an interrupted run leaves no partial entry
+            tmp_file = f"{prefix}.{name}.{os.getpid()}.tmp.npy"
+            np.save(tmp_file, array)
+            os.replace(tmp_file, f"{prefix}.{name}.npy")
+
+    def __len__(self):
+        return len(self.arrays['labels'])
+
+    def __getitem__(self, index):
+        input_ids = np.array(self.arrays['input_ids'][index])
+        return {
+            'input_ids': input_ids,
+            'attention_mask': np.array(self.arrays['attention_mask'][index]),
+            'token_type_ids': np.zeros_like(input_ids),
+            'labels': self.arrays['labels'][index],
+        }
+
+
+def sequence_lengths(dataset):
+    """Number of unpadded tokens in each example of dataset."""
+    if isinstance(dataset, CachedTokenizedDataset):
+        return np.asarray(dataset.arrays['attention_mask']).sum(axis=1)
+    if isinstance(dataset, WordPieceRegressionDataset):
+        return np.minimum(np.diff(dataset.offsets), dataset.max_sequence_length - 2) + 2
+    return np.asarray([int(np.sum(dataset[i]['attention_mask'])) for i in range(len(dataset))])
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler yielding example indices sorted by length, shortest
+    first, so each batch holds sequences of about the same length and
+    pads only to its own longest one. Every index is yielded once.
+    """
+
+    def __init__(self, lengths, batch_size):
+        order = np.argsort(lengths, kind='stable')
+        self.batches = [order[i:i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """
+    Adds each example's index to its features, so out-of-order batches can
+    be written back in order. With indices, only those examples are served.
+    """
+
+    def __init__(self, dataset, indices=None):
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.dataset) if self.indices is None else len(self.indices)
+
+    def __getitem__(self, index):
+        if self.indices is not None:
+            index = int(self.indices[index])
+        return dict(self.dataset[index], index=index)
+
+
+def pad_to_longest(items, pad_to_multiple_of=8):
+    """
+    Collate examples padded to max_sequence_length into a batch cut down to
+    its longest sequence, rounded up to a multiple of pad_to_multiple_of.
+    """
+    msl = len(items[0]['input_ids'])
+    longest = max(int(np.sum(item['attention_mask'])) for item in items)
+    length = min(msl, -(-longest // pad_to_multiple_of) * pad_to_multiple_of)
+    trimmed = [
+        {name: value[:length] if name in ('input_ids', 'attention_mask', 'token_type_ids') else value
+         for name, value in item.items()}
+        for item in items
+    ]
+    return torch.utils.data.default_collate(trimmed)
+
+
+def length_bucketed_dataloader(dataset, batch_size, pad_to_multiple_of=8, indices=None, **kwargs):
+    """
+    DataLoader over dataset (or the examples at indices) in
+    LengthBucketSampler order, each batch padded by pad_to_longest.
+    """
+    lengths = sequence_lengths(dataset)
+    if indices is not None:
+        lengths = lengths[indices]
+    return torch.utils.data.DataLoader(
+        IndexedDataset(dataset, indices),
+        batch_sampler=LengthBucketSampler(lengths, batch_size),
+        collate_fn=functools.partial(pad_to_longest, pad_to_multiple_of=pad_to_multiple_of),
+        **kwargs,
+    )
+
+
+def _finite_or_none(value):
+    return value if math.isfinite(value) else None
+
+
+def _none_to_nan(value):
+    return float('nan') if value is None else value
+
+
+class PredictionStream:
+    """
+    Predictions appended to a JSONL file as they are made and flushed after
+    every batch: a header line describing the run, then one
+    {"index", "pred", "label"} line per example. Non-finite values are
+    written as null, which keeps every line valid JSON.
+
+    Opening an existing file for the same run resumes it. A torn last line
+    is cut off, the examples already written are marked in self.written,
+    and their predictions are folded into self.metrics and the squared
+    error, so the metrics still cover the whole set in one pass.
+    """
+
+    def __init__(self, path, header, num_examples, chunk_size=1 << 16):
+        self.path = path
+        self.written = np.zeros(num_examples, dtype=bool)
+        self.metrics = RegressionMetrics(device)
+        self.squared_error = 0.
+        if os.path.exists(path) and os.path.getsize(path):
+            self._resume(header, chunk_size)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(json.dumps(header) + "\n")
+        self.file = open(path, 'a')
+        if self.resumed:
+            print(f"[INFO] Resuming {path}: {self.resumed} of {num_examples} examples already predicted")
+
+    @property
+    def resumed(self):
+        return int(self.written.sum())
+
+    def _resume(self, header, chunk_size):
+        indices, preds, labels = [], [], []
+        with open(self.path, 'rb') as f:
+            first = f.readline()
+            if json.loads(first) != header:
+                raise ValueError(f"{self.path} holds predictions of another run ({first.decode().strip()}); "
+                                 f"remove it or choose another --predictions_file")
+            end = f.tell()
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                indices.append(record['index'])
+                preds.append(record['pred'])
+                labels.append(record['label'])
+                if len(indices) == chunk_size:
+                    self._fold(indices, preds, labels)
+                    indices, preds, labels = [], [], []
+        self._fold(indices, preds, labels)
+        # drop whatever a crash left half written
+        os.truncate(self.path, end)
+
+    def _fold(self, indices, preds, labels):
+        if not indices:
+            return
+        self.written[indices] = True
+        preds = torch.tensor([_none_to_nan(pred) for pred in preds], dtype=torch.float64, device=device)
+        labels = torch.tensor([_none_to_nan(label) for label in labels], dtype=torch.float64, device=device)
+        self.metrics.update(preds, labels)
+        self.squared_error += float(((preds - labels) ** 2).sum())
+
+    def write(self, indices, preds, labels):
+        self.file.write("".join(
+            json.dumps({"index": index, "pred": _finite_or_none(pred), "label": _finite_or_none(label)}) + "\n"
+            for index, pred, label in zip(indices.tolist(), preds.tolist(), labels.tolist())
+        ))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def run_model(model, dataloader, autocast=False, attention_mask=False, stream=None):
+    """
+    Predict every example without syncing the device per batch: predictions
+    and labels go into buffers sized from the dataset, loss and metrics are
+    summed on the device, and everything is copied back once at the end.
+
+    Batches carrying an 'index' (see length_bucketed_dataloader) are
+    written to those positions, so the outputs keep dataset order.
+    attention_mask passes the batch's mask to the model, which makes the
+    predictions independent of how far the batch is padded.
+
+    With a PredictionStream, each batch goes to the stream instead (its
+    batches must carry an 'index'), nothing is kept in memory, and loss
+    and metrics continue from the examples the stream resumed.
+    """
+    num_examples = len(dataloader.dataset)
+    if stream is None:
+        preds = torch.empty(num_examples, dtype=torch.float32, device=device)
+        true = torch.empty(num_examples, dtype=torch.float32, device=device)
+        running_loss = torch.zeros((), dtype=torch.float64, device=device)
+        metrics = RegressionMetrics(device)
+        count = 0
+    else:
+        running_loss = torch.tensor(stream.squared_error, dtype=torch.float64, device=device)
+        metrics = stream.metrics
+        count = stream.resumed
+    data_time = 0.
+    start = time.perf_counter()
+
+    with torch.no_grad(), autocast_context(autocast):
+        batches = iter(dataloader)
+        for i in tqdm(range(len(dataloader))):
+            # time blocked waiting for the loader; the rest of the loop is compute
+            wait_start = time.perf_counter()
+            data = next(batches)
+            data_time += time.perf_counter() - wait_start
+            input_ids = data['input_ids'].to(device, non_blocking=True)
+            labels = data['labels'].to(device, non_blocking=True).float()
+            if attention_mask:
+                outputs = model(input_ids, attention_mask=data['attention_mask'].to(device, non_blocking=True))
+            else:
+                outputs = model(input_ids)
+            logits = outputs.logits.reshape(-1).float()
+            batch_size = labels.size(0)
+            if stream is not None:
+                stream.write(data['index'], logits.cpu(), labels.cpu())
+            elif 'index' in data:
+                index = data['index'].to(device, non_blocking=True)
+                preds[index] = logits
+                true[index] = labels
+            else:
+                preds[count:count + batch_size] = logits
+                true[count:count + batch_size] = labels
+            running_loss += loss_fn(logits, labels).double() * batch_size
+            metrics.update(logits, labels)
+            count += batch_size
+
+    running_loss = (running_loss / count).item()
+    total_time = time.perf_counter() - start
+    print("RUNNING LOSS:", running_loss)
+    print(f"[INFO] {total_time:.2f}s: waiting on data {data_time:.2f}s, compute {total_time - data_time:.2f}s")
+    values = {
+        'preds': None if stream is not None else preds[:count].cpu().numpy(),
+        'labels': None if stream is not None else true[:count].cpu().numpy(),
+        'loss': running_loss,
+        'metrics': metrics.compute(),
+        'timing': {'total_seconds': total_time, 'data_seconds': data_time,
+                   'compute_seconds': total_time - data_time},
+    }
     return values
 
 
+def resolve_checkpoints(checkpoint_path, steps=None):
+    """
+    Checkpoint files named by checkpoint_path: a file, a glob such as
+    checkpoint_*.mdl, or a path containing {step} filled in from steps
+    ("start:stop:step", stop included). Sorted by training step.
+    """
+    if steps is not None:
+        start, stop, step = (int(part) for part in steps.split(':'))
+        paths = [checkpoint_path.format(step=s) for s in range(start, stop + 1, step)]
+    elif glob.has_magic(checkpoint_path):
+        paths = glob.glob(checkpoint_path)
+    else:
+        paths = [checkpoint_path]
+    return sorted(paths, key=lambda path: (checkpoint_step(path) is None, checkpoint_step(path) or 0, path))
+
+
+def checkpoint_step(path):
+    match = re.search(r'checkpoint_(\d+)', os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def load_checkpoint(path):
+    return torch.load(path, weights_only=True, map_location='cpu')['model']
+
+
+def evaluate_checkpoints(model, dataloader, checkpoints, autocast=False, attention_mask=False):
+    """
+    Evaluate one model and one dataloader against every checkpoint by
+    swapping state dicts. The next checkpoint is read on a background
+    thread while the current one is evaluated. Returns a row of metrics
+    per checkpoint, and the checkpoints that could not be loaded with
+    their errors.
+    """
+    rows = []
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as loader:
+        pending = loader.submit(load_checkpoint, checkpoints[0])
+        for i, path in enumerate(checkpoints):
+            try:
+                state_dict = pending.result()
+            except (OSError, RuntimeError, KeyError, pickle.UnpicklingError) as e:
+                print(f"[INFO] Skipping {path}: {e}")
+                failed.append({'checkpoint': path, 'error': str(e)})
+                state_dict = None
+            if i + 1 < len(checkpoints):
+                pending = loader.submit(load_checkpoint, checkpoints[i + 1])
+            if state_dict is None:
+                continue
+            model.load_state_dict(state_dict)
+            del state_dict
+            values = run_model(model, dataloader, autocast=autocast, attention_mask=attention_mask)
+            rows.append(dict(checkpoint=path, step=checkpoint_step(path), loss=values['loss'], **values['metrics']))
+    return rows, failed
+
+
+def print_checkpoint_table(rows, best):
+    print(f"{'step':>8} {'loss':>10} {'MAE':>10} {'MSE':>10} {'R^2':>10}  checkpoint")
+    for row in rows:
+        marker = '  <- best' if row is best else ''
+        step = '-' if row['step'] is None else row['step']
+        print(f"{step:>8} {row['loss']:>10.6f} {row['mae']:>10.6f} {row['mse']:>10.6f} {row['r2']:>10.6f}  "
+              f"{row['checkpoint']}{marker}")
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--params', default='regression_params_inference.yaml',
+                    help="model and input params; defaults to regression_params_inference.yaml in the working directory")
+parser.add_argument('--checkpoint_path',
+                    help="checkpoint to evaluate; a glob or a path with {step} (see --steps) evaluates several")
+parser.add_argument('--steps', default=None,
+                    help="start:stop:step filled into {step} of --checkpoint_path, stop included, e.g. 0:3000:100")
+parser.add_argument('--outfile')
+parser.add_argument('--fast_tokenizer', action='store_true',
+                    help="tokenize dev.tsv with wordpiece.py's batched tokenizer instead of SST2Dataset")
+parser.add_argument('--autocast', action='store_true',
+                    help="run the model under autocast: bf16 on CPU, fp16 on CUDA")
+parser.add_argument('--compare_fp32', action='store_true',
+                    help="with --autocast, also run in fp32 and report how far the predictions and metrics move")
+parser.add_argument('--dataset_cache', default=None,
+                    help="directory caching the tokenized eval set as memory-mapped .npy files, "
+                         "keyed by the TSV, the vocab and the tokenizer settings")
+parser.add_argument('--num_workers', type=int, default=None,
+                    help="DataLoader worker processes; defaults to eval_input.num_workers, else 0")
+parser.add_argument('--prefetch_factor', type=int, default=2,
+                    help="batches each DataLoader worker loads ahead")
+parser.add_argument('--dynamic_padding', action='store_true',
+                    help="batch examples of similar length and pad each batch only to its longest sequence; "
+                         "passes attention_mask to the model, so padding no longer affects the predictions")
+parser.add_argument('--pad_to_multiple_of', type=int, default=8,
+                    help="with --dynamic_padding, round each batch's length up to a multiple of this")
+parser.add_argument('--benchmark_padding', action='store_true',
+                    help="time samples/sec with batches padded to max_sequence_length against "
+                         "--dynamic_padding, write the results to --outfile and exit")
+parser.add_argument('--device', choices=['cpu', 'cuda'], default=None,
+                    help="defaults to cuda when available")
+parser.add_argument('--predictions_file', default=None,
+                    help="stream predictions to this JSONL file batch by batch, resuming it if it exists, "
+                         "and leave only the summary in --outfile")
+args = parser.parse_args()
+if args.predictions_file and args.compare_fp32:
+    parser.error("--compare_fp32 needs the predictions in memory; drop --predictions_file")
+
 # ======Shreya================
-with open('regression_params_inference.yaml', 'r') as f:
+with open(args.params, 'r') as f:
     params = yaml.safe_load(f)
 f.close()
 # =========Shreya==============
@@ -82,37 +547,135 @@ config = BertConfig(
 
 loss_fn = MSELoss()
 
-if torch.cuda.is_available():
+if args.device is not None:
+    device = args.device
+elif torch.cuda.is_available():
     device = 'cuda'
 else:
     device = 'cpu'
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--checkpoint_path')
-parser.add_argument('--outfile')
-args = parser.parse_args()
+checkpoints = resolve_checkpoints(args.checkpoint_path, args.steps)
+# --steps may name checkpoints that were never written; report them instead of failing the run
+missing = [path for path in checkpoints if not os.path.isfile(path)]
+if missing:
+    print(f"[INFO] Skipping {len(missing)} missing checkpoint(s): {', '.join(missing)}")
+    checkpoints = [path for path in checkpoints if path not in missing]
+if not checkpoints:
+    raise SystemExit(f"No checkpoints match {args.checkpoint_path}")
+if args.predictions_file and len(checkpoints) > 1:
+    parser.error("--predictions_file takes a single checkpoint")
 
 model = BertForSequenceClassification(config)
-model.load_state_dict(torch.load(args.checkpoint_path, weights_only=True, map_location=device)['model'])
-dataset = SST2Dataset(params['train_input'], is_training=False)
-dataloader = torch.utils.data.DataLoader(dataset, batch_size=params['eval_input'].get('batch_size'), shuffle=False)
+if len(checkpoints) == 1 or args.benchmark_padding:
+    # evaluate_checkpoints loads the weights of every checkpoint itself
+    model.load_state_dict(load_checkpoint(checkpoints[0]))
+model.to(device)
+tokenizer_name = 'wordpiece' if args.fast_tokenizer else 'SST2Dataset'
+if args.fast_tokenizer:
+    def build_dataset():
+        return WordPieceRegressionDataset(params['train_input'], is_training=False)
+else:
+    def build_dataset():
+        return SST2Dataset(params['train_input'], is_training=False)
+if args.dataset_cache:
+    dataset = CachedTokenizedDataset(params['train_input'], args.dataset_cache, build_dataset, tokenizer_name)
+else:
+    dataset = build_dataset()
+num_workers = args.num_workers if args.num_workers is not None else params['eval_input'].get('num_workers', 0)
+batch_size = params['eval_input'].get('batch_size')
+loader_options = dict(num_workers=num_workers, pin_memory=device == 'cuda',
+                      prefetch_factor=args.prefetch_factor if num_workers > 0 else None,
+                      persistent_workers=num_workers > 0)
+stream = None
+remaining = None
+if args.predictions_file:
+    stream = PredictionStream(args.predictions_file, {
+        'checkpoint': os.path.abspath(checkpoints[0]),
+        'num_examples': len(dataset),
+        'attention_mask': args.dynamic_padding,
+        'autocast': args.autocast,
+        **eval_set_key(params['train_input'], tokenizer_name),
+    }, len(dataset))
+    remaining = np.flatnonzero(~stream.written)
+if args.dynamic_padding:
+    dataloader = length_bucketed_dataloader(dataset, batch_size, args.pad_to_multiple_of, remaining,
+                                            **loader_options)
+elif stream is not None:
+    dataloader = torch.utils.data.DataLoader(IndexedDataset(dataset, remaining), batch_size=batch_size,
+                                             shuffle=False, **loader_options)
+else:
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, **loader_options)
 model.eval()
-values = run_model(model, dataloader)
 
-# =========Shreya================
-preds_np = np.asarray(values["preds"], dtype=np.float32)
-labels_np = np.asarray(values["labels"], dtype=np.float32)
+if args.benchmark_padding:
+    # both paths pass attention_mask so their predictions should agree
+    fixed = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, **loader_options)
+    dynamic = length_bucketed_dataloader(dataset, batch_size, args.pad_to_multiple_of, **loader_options)
+    lengths = sequence_lengths(dataset)
+    results = {'device': device, 'num_examples': len(dataset), 'batch_size': batch_size,
+               'max_sequence_length': len(dataset[0]['input_ids']),
+               'mean_sequence_length': float(np.mean(lengths))}
+    outputs = {}
+    for name, loader in (('fixed', fixed), ('dynamic', dynamic)):
+        outputs[name] = run_model(model, loader, autocast=args.autocast, attention_mask=True)
+        seconds = outputs[name]['timing']['total_seconds']
+        results[name] = {'seconds': seconds, 'samples_per_second': len(dataset) / seconds,
+                         'mae': outputs[name]['metrics']['mae']}
+        print(f"[INFO] {name} padding: {len(dataset) / seconds:.1f} samples/sec")
+    results['speedup'] = results['fixed']['seconds'] / results['dynamic']['seconds']
+    results['max_abs_pred_diff'] = float(np.abs(outputs['fixed']['preds'] - outputs['dynamic']['preds']).max())
+    print(f"[INFO] dynamic padding is {results['speedup']:.2f}x faster; "
+          f"predictions differ by up to {results['max_abs_pred_diff']:.2e}")
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0)
+
+if len(checkpoints) > 1:
+    # one table of metrics per checkpoint, and the checkpoint with the lowest MAE
+    rows, failed = evaluate_checkpoints(model, dataloader, checkpoints, autocast=args.autocast,
+                                        attention_mask=args.dynamic_padding)
+    best = min(rows, key=lambda row: row['mae'], default=None)
+    print_checkpoint_table(rows, best)
+    skipped = [{'checkpoint': path, 'error': 'missing'} for path in missing] + failed
+    with open(args.outfile, 'w') as f:
+        json.dump({'checkpoints': rows, 'best': best, 'skipped': skipped}, f, indent=2)
+    sys.exit(0 if rows else 1)
 
-mae = get_mae(labels_np, preds_np)
-r2 = get_rsquared(labels_np, preds_np)
+values = run_model(model, dataloader, autocast=args.autocast, attention_mask=args.dynamic_padding, stream=stream)
 
-print(f"MAE: {mae:.6f}")
-print(f"R^2: {r2:.6f}")
+# =========Shreya================
+metrics = values.pop("metrics")
+print(f"MAE: {metrics['mae']:.6f}")
+print(f"R^2: {metrics['r2']:.6f}")
+
+if args.autocast and args.compare_fp32:
+    reference = run_model(model, dataloader, autocast=False, attention_mask=args.dynamic_padding)
+    reference_metrics = reference["metrics"]
+    pred_diff = np.abs(values["preds"] - reference["preds"])
+    values["fp32_comparison"] = {
+        "max_abs_pred_diff": float(pred_diff.max()),
+        "mean_abs_pred_diff": float(pred_diff.mean()),
+        "fp32_mae": reference_metrics["mae"],
+        "fp32_r2": reference_metrics["r2"],
+    }
+    print(f"fp32 MAE: {reference_metrics['mae']:.6f}, R^2: {reference_metrics['r2']:.6f}; "
+          f"autocast predictions differ by up to {pred_diff.max():.6f}")
 
 # add metrics to JSON
+if stream is not None:
+    # the predictions are in the JSONL file; the summary only points at it
+    stream.close()
+    del values["preds"], values["labels"]
+    values["predictions_file"] = os.path.abspath(args.predictions_file)
+    values["num_examples"] = len(dataset)
+else:
+    values["preds"] = values["preds"].tolist()
+    values["labels"] = values["labels"].tolist()
 values["metrics"] = {
-    "mae": float(mae),
-    "r2": float(r2)
+    "mae": metrics["mae"],
+    "mse": metrics["mse"],
+    "r2": metrics["r2"]
 }
 # ====== Shreya ================
 
@@ -5,4 +5,6 @@
 ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
 
 # TODO: Run after the "run_regression.py" substep has finished.
-python run_inference.py --checkpoint_path ${ENTRY_LOCATION}/regression_OCELOT/ms_OCELOT/checkpoint_2100.mdl --outfile inference_MS_OCELOT.json
\ No newline at end of file
+# predictions stream to a JSONL file outside the job directory so a rerun resumes it
+mkdir -p ${ENTRY_LOCATION}/inference
+python run_inference.py --checkpoint_path ${ENTRY_LOCATION}/regression_OCELOT/ms_OCELOT/checkpoint_2100.mdl --outfile inference_MS_OCELOT.json --dataset_cache ${ENTRY_LOCATION}/cache/inference --num_workers 4 --predictions_file ${ENTRY_LOCATION}/inference/inference_MS_OCELOT.predictions.jsonl
\ No newline at end of file
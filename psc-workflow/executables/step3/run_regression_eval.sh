@@ -12,24 +12,17 @@ conda activate /ocean/projects/sys890003p/spagaria/project1/regression
 
 ENTRY_LOCATION=/ocean/projects/sys890003p/spagaria/project1/dana
 MODEL_DIR=${ENTRY_LOCATION}/regression_OCELOT/ms_OCELOT    ##make changes here
-PARAMS=${ENTRY_LOCATION}/regression_params.yaml    ##make changes here 
+PARAMS=${ENTRY_LOCATION}/regression_params_inference.yaml    ##make changes here 
 
 cd "${ENTRY_LOCATION}"
 
-# TODO: Skipping for now.
-## Loop over checkpoints from 0 to 4000 in steps of 100 [you can make changes here as well as in the loop condition]
-#for (( STEP=0; STEP<=3000; STEP+=100 )); do
-#
-#    CKPT=${MODEL_DIR}/checkpoint_${STEP}.mdl
-#    EVAL_OUT=${MODEL_DIR}/eval_inf/eval_${STEP}
-#
-#    echo "Evaluating ${CKPT}"
-#
-#    python3 run_regression.py \
-#        --mode eval \
-#        --model_dir "${EVAL_OUT}" \
-#        --params "${PARAMS}" \
-#        --checkpoint_path "${CKPT}"
-#
-#    echo "Done with checkpoint ${STEP}"
-#done
+# Evaluate checkpoints 0 to 3000 in steps of 100 in one process: the dataset is tokenized and the
+# model built once, and each checkpoint's weights are swapped in [you can change the range here]
+mkdir -p ${MODEL_DIR}/eval_inf
+python3 run_inference.py \
+    --params "${PARAMS}" \
+    --checkpoint_path "${MODEL_DIR}/checkpoint_{step}.mdl" \
+    --steps 0:3000:100 \
+    --dataset_cache "${ENTRY_LOCATION}/cache/inference" \
+    --num_workers 4 \
+    --outfile "${MODEL_DIR}/eval_inf/checkpoints.json"
@@ -14,6 +14,7 @@ https://portal.neocortex.psc.edu/docs/running-jobs.html
 import argparse
 import getpass
 import logging
+import math
 import os
 import shutil
 import sys
@@ -41,11 +42,55 @@ BRIDGES2_SITE_HANDLE = "bridges2"
 
 ENTRY_LOCATION = "/ocean/projects/sys890003p/spagaria/project1/dana"
 
+# create_regression_csv.py is fanned out over shards of the OCELOT dataset, as many as
+# the structures in the packed dataset need. The serial cost per CIF is the mean of the
+# featurize_timing.tsv of an earlier run (--featurize_timing_log). Without one it is a
+# rough estimate, not a measurement: the 5 hours of the single job is only its walltime
+# request.
+REGRESSION_CIF_PACK = f"{BASE_DIR}/inputs/step2/merged_dataset_ocelot.cifpack"
+FEATURIZE_SECONDS_PER_CIF_ESTIMATE = 1.9
+# a shard job is one Pegasus task (cores=1) with this many CPUs, one worker process each
+FEATURIZE_CPUS_PER_JOB = 28
+FEATURIZE_TARGET_RUNTIME = 60 * 5
+# walltime of a shard job; twice the target runtime leaves headroom for slow structures.
+# The #SBATCH -t of create_regression_csv_shard.sh matches it.
+FEATURIZE_JOB_RUNTIME = 2 * FEATURIZE_TARGET_RUNTIME
+
+
+def count_regression_cifs(pack_path=REGRESSION_CIF_PACK):
+    """Number of rows in the targets file of the packed dataset, or None if it has not been packed yet."""
+    if not os.path.exists(pack_path):
+        return None
+    sys.path.append(f"{BASE_DIR}/executables/step2")
+    from pack_cifs import CifPack
+
+    pack = CifPack(pack_path)
+    try:
+        return len(pack.target_rows())
+    finally:
+        pack.close()
+
+
+def featurize_seconds_per_cif(timing_log=None):
+    """Mean seconds per structure in a featurize_timing.tsv, or the estimate without one."""
+    if timing_log is None:
+        return FEATURIZE_SECONDS_PER_CIF_ESTIMATE
+    with open(timing_log, 'r') as f:
+        seconds = [float(line.split('\t')[1]) for line in f.readlines()[1:] if line.strip()]
+    return sum(seconds) / len(seconds) if seconds else FEATURIZE_SECONDS_PER_CIF_ESTIMATE
+
+
+def featurize_shard_count(num_cifs, seconds_per_cif, target_runtime=FEATURIZE_TARGET_RUNTIME):
+    """Number of featurization jobs needed for each to finish in about target_runtime seconds."""
+    job_seconds = num_cifs * seconds_per_cif / FEATURIZE_CPUS_PER_JOB
+    return max(1, math.ceil(job_seconds / target_runtime))
+
 
 class CerebrasPyTorchWorkflow:
 
     # --- Init ---------------------------------------------------------------------
-    def __init__(self, project=None):
+    def __init__(self, project=None, featurize_shards=None, single_csv_job=False, build_vocab=False,
+                 featurize_timing_log=None):
         self.site_catalog = SiteCatalog()
         self.transformation_catalog = TransformationCatalog()
         self.replica_catalog = ReplicaCatalog()
@@ -53,8 +98,23 @@ class CerebrasPyTorchWorkflow:
         self.workflow_name = "psc-workflow"
         self.workflow = Workflow(name=self.workflow_name)
         self.project = project
+        self.single_csv_job = single_csv_job
+        self.build_vocab = build_vocab
         # Log
         self.log = logging.getLogger(__name__)
+        if featurize_shards is None:
+            num_cifs = count_regression_cifs()
+            if num_cifs is None:
+                self.log.warning(f"{REGRESSION_CIF_PACK} not found; featurizing the regression dataset in one job")
+                featurize_shards = 1
+            else:
+                seconds_per_cif = featurize_seconds_per_cif(featurize_timing_log)
+                if featurize_timing_log is None:
+                    self.log.warning(f"No --featurize_timing_log; assuming an estimated {seconds_per_cif}s per structure")
+                featurize_shards = featurize_shard_count(num_cifs, seconds_per_cif)
+                self.log.info(f"{num_cifs} structures in {REGRESSION_CIF_PACK} at {seconds_per_cif:.2f}s each: "
+                              f"{featurize_shards} featurization jobs")
+        self.featurize_shards = featurize_shards
 
     # --- Write files in directory -------------------------------------------------
     def write(self):
@@ -208,6 +268,19 @@ class CerebrasPyTorchWorkflow:
                                                                        glite_arguments="--cpus-per-task=28")
         self.transformation_catalog.add_transformations(prepare_tokenization_split_transformation)
 
+        # build_vocab.py
+        build_vocab_transformation = Transformation(
+            name="build_vocab_transformation",
+            site="local",
+            pfn=f"{BASE_DIR}/executables/step1/build_vocab.sh",
+            is_stageable=True,
+        )
+        build_vocab_transformation.add_pegasus_profiles(cores=1, runtime="300",
+                                                        container_launcher="srun",
+                                                        container_launcher_arguments="--kill-on-bad-exit",
+                                                        glite_arguments="--cpus-per-task=28")
+        self.transformation_catalog.add_transformations(build_vocab_transformation)
+
         # create_csv_mlm_only.py train, val, test
         for mode in "train", "val", "test":
             create_csv_mlm_only_transformation = Transformation(
@@ -222,6 +295,19 @@ class CerebrasPyTorchWorkflow:
                                                                     glite_arguments="--cpus-per-task=28")
             self.transformation_catalog.add_transformations(create_csv_mlm_only_transformation)
 
+        # create_csv_mlm_only.py train, val and test in a single job
+        create_csv_mlm_only_transformation = Transformation(
+            name="create_csv_mlm_only_transformation",
+            site="local",
+            pfn=f"{BASE_DIR}/executables/step1/create_csv_mlm_only.sh",
+            is_stageable=True,
+        )
+        create_csv_mlm_only_transformation.add_pegasus_profiles(cores=1, runtime="900",
+                                                                container_launcher="srun",
+                                                                container_launcher_arguments="--kill-on-bad-exit",
+                                                                glite_arguments="--cpus-per-task=28")
+        self.transformation_catalog.add_transformations(create_csv_mlm_only_transformation)
+
         # [Neocortex] run_roberta.py
         run_roberta_transformation = Transformation(
             name="run_roberta_transformation",
@@ -249,6 +335,36 @@ class CerebrasPyTorchWorkflow:
                                                                   glite_arguments="--cpus-per-task=28")
         self.transformation_catalog.add_transformations(create_regression_csv_transformation)
 
+        # create_regression_csv.py, one shard of the dataset
+        create_regression_csv_shard_transformation = Transformation(
+            name="create_regression_csv_shard_transformation",
+            site="local",
+            pfn=f"{BASE_DIR}/executables/step2/create_regression_csv_shard.sh",
+            is_stageable=True,
+        )
+        # one task with FEATURIZE_CPUS_PER_JOB CPUs, which the job passes on as --workers
+        create_regression_csv_shard_transformation.add_pegasus_profiles(cores=1,
+                                                                        runtime=str(FEATURIZE_JOB_RUNTIME),
+                                                                        queue="RM-shared",
+                                                                        container_launcher="srun",
+                                                                        container_launcher_arguments="--kill-on-bad-exit",
+                                                                        glite_arguments=f"--cpus-per-task={FEATURIZE_CPUS_PER_JOB}")
+        self.transformation_catalog.add_transformations(create_regression_csv_shard_transformation)
+
+        # create_regression_csv.py --merge_shards
+        merge_regression_csv_transformation = Transformation(
+            name="merge_regression_csv_transformation",
+            site="local",
+            pfn=f"{BASE_DIR}/executables/step2/merge_regression_csv.sh",
+            is_stageable=True,
+        )
+        merge_regression_csv_transformation.add_pegasus_profiles(cores=1, runtime="300",
+                                                                 queue="RM-shared",
+                                                                 container_launcher="srun",
+                                                                 container_launcher_arguments="--kill-on-bad-exit",
+                                                                 glite_arguments="--cpus-per-task=1")
+        self.transformation_catalog.add_transformations(merge_regression_csv_transformation)
+
         # run_regression.py
         run_regression_transformation = Transformation(
             name="run_regression_transformation",
@@ -291,6 +407,7 @@ class CerebrasPyTorchWorkflow:
 
         ## Main Workflow Steps
         # prepare_tokenization_split.py
+        # build_vocab.py (with --build_vocab)
         # create_csv_mlm_only.py train
         # create_csv_mlm_only.py val
         # create_csv_mlm_only.py test
@@ -331,29 +448,59 @@ class CerebrasPyTorchWorkflow:
             pfn=f"{BASE_DIR}/inputs/step1/roberta_params_OCELOT_MS.yaml"
         )
 
-        #### create_csv_mlm_only.py train
-        create_csv_mlm_only_train_job = Job(transformation="create_csv_mlm_only_train_transformation",
-                                            node_label="create_csv_mlm_only_train_label")
-        self.workflow.add_jobs(create_csv_mlm_only_train_job)
-
-        create_csv_mlm_only_train_job.add_inputs(pretraining_output_tar, tokenizer_vobac_input_file)
-        create_csv_mlm_only_train_job.add_outputs(csv_train_tar)
-
-        #### create_csv_mlm_only.py val
-        create_csv_mlm_only_val_job = Job(transformation="create_csv_mlm_only_val_transformation",
-                                          node_label="create_csv_mlm_only_val_label")
-        self.workflow.add_jobs(create_csv_mlm_only_val_job)
-
-        create_csv_mlm_only_val_job.add_inputs(pretraining_output_tar, tokenizer_vobac_input_file)
-        create_csv_mlm_only_val_job.add_outputs(csv_val_tar)
-
-        #### create_csv_mlm_only.py test
-        create_csv_mlm_only_test_job = Job(transformation="create_csv_mlm_only_test_transformation",
-                                           node_label="create_csv_mlm_only_test_label")
-        self.workflow.add_jobs(create_csv_mlm_only_test_job)
-
-        create_csv_mlm_only_test_job.add_inputs(pretraining_output_tar, tokenizer_vobac_input_file)
-        create_csv_mlm_only_test_job.add_outputs(csv_test_tar)
+        ### build_vocab.py
+        # a compact vocab from the train split replaces the tokenizer vocab; the job also
+        # sets vocab_size and vocab_file in the pretraining and regression params
+        if self.build_vocab:
+            compact_vocab_output_file = File("materials_string_OCELOT_compact.txt")
+            build_vocab_job = Job(transformation="build_vocab_transformation", node_label="build_vocab_label")
+            self.workflow.add_jobs(build_vocab_job)
+
+            build_vocab_job.add_inputs(pretraining_output_tar)
+            # build_vocab.sh copies the vocab into the job's working directory for stage-out
+            build_vocab_job.add_outputs(compact_vocab_output_file)
+            tokenizer_vobac_input_file = compact_vocab_output_file
+
+        if self.single_csv_job:
+            #### create_csv_mlm_only.py train, val and test in one job
+            create_csv_mlm_only_job = Job(transformation="create_csv_mlm_only_transformation",
+                                          node_label="create_csv_mlm_only_label")
+            self.workflow.add_jobs(create_csv_mlm_only_job)
+
+            create_csv_mlm_only_job.add_inputs(pretraining_output_tar, tokenizer_vobac_input_file)
+            create_csv_mlm_only_job.add_outputs(csv_train_tar, csv_val_tar, csv_test_tar)
+            create_csv_mlm_only_jobs = [create_csv_mlm_only_job, ]
+        else:
+            #### create_csv_mlm_only.py train
+            create_csv_mlm_only_train_job = Job(transformation="create_csv_mlm_only_train_transformation",
+                                                node_label="create_csv_mlm_only_train_label")
+            self.workflow.add_jobs(create_csv_mlm_only_train_job)
+
+            create_csv_mlm_only_train_job.add_inputs(pretraining_output_tar, tokenizer_vobac_input_file)
+            create_csv_mlm_only_train_job.add_outputs(csv_train_tar)
+
+            #### create_csv_mlm_only.py val
+            create_csv_mlm_only_val_job = Job(transformation="create_csv_mlm_only_val_transformation",
+                                              node_label="create_csv_mlm_only_val_label")
+            self.workflow.add_jobs(create_csv_mlm_only_val_job)
+
+            create_csv_mlm_only_val_job.add_inputs(pretraining_output_tar, tokenizer_vobac_input_file)
+            create_csv_mlm_only_val_job.add_outputs(csv_val_tar)
+
+            #### create_csv_mlm_only.py test
+            create_csv_mlm_only_test_job = Job(transformation="create_csv_mlm_only_test_transformation",
+                                               node_label="create_csv_mlm_only_test_label")
+            self.workflow.add_jobs(create_csv_mlm_only_test_job)
+
+            create_csv_mlm_only_test_job.add_inputs(pretraining_output_tar, tokenizer_vobac_input_file)
+            create_csv_mlm_only_test_job.add_outputs(csv_test_tar)
+            create_csv_mlm_only_jobs = [create_csv_mlm_only_train_job,
+                                        create_csv_mlm_only_val_job,
+                                        create_csv_mlm_only_test_job, ]
+        if self.build_vocab:
+            for create_csv_mlm_only_job in create_csv_mlm_only_jobs:
+                create_csv_mlm_only_job.add_env(
+                    VOCAB_FILE=f"{ENTRY_LOCATION}/tokenizer/materials_string_OCELOT_compact.txt")
 
         ### python-pt run_roberta.py
         run_roberta_job = Job(transformation="run_roberta_transformation", node_label="run_roberta_label")
@@ -371,11 +518,13 @@ class CerebrasPyTorchWorkflow:
             site="local", lfn=regression_params_yaml_input_file.lfn,
             pfn=f"{BASE_DIR}/inputs/step2/regression_params.yaml"
         )
-        # TODO: Compress in .sh file. 85MB total, split across 9579 files. {ENTRY_LOCATION}/Merged_Dataset/OCELOT
-        merged_dataset_ocelot_input_tar_file = File("merged_dataset_ocelot.tgz")
+        # 85MB total, split across 9579 files in {ENTRY_LOCATION}/Merged_Dataset/OCELOT, packed into a single
+        # indexed file with executables/step2/pack_cifs.py so only one file is staged:
+        # python3 pack_cifs.py --data_dir {ENTRY_LOCATION}/Merged_Dataset/OCELOT --outfile inputs/step2/merged_dataset_ocelot.cifpack
+        merged_dataset_ocelot_input_pack_file = File("merged_dataset_ocelot.cifpack")
         self.replica_catalog.add_replica(
-            site="local", lfn=merged_dataset_ocelot_input_tar_file.lfn,
-            pfn=f"{BASE_DIR}/inputs/step2/merged_dataset_ocelot.tgz"
+            site="local", lfn=merged_dataset_ocelot_input_pack_file.lfn,
+            pfn=REGRESSION_CIF_PACK
         )
         regression_OCELOT__ms_OCELOT_output_tar = File("regression_OCELOT__ms_OCELOT.tgz")
         inference_MS_OCELOT_json_output_file = File("inference_MS_OCELOT.json")
@@ -392,11 +541,32 @@ class CerebrasPyTorchWorkflow:
         )
 
         ### create_regression_csv.py
-        create_regression_csv_job = Job(transformation="create_regression_csv_transformation",
-                                        node_label="create_regression_csv_label")
-        self.workflow.add_jobs(create_regression_csv_job)
-        create_regression_csv_job.add_inputs(merged_dataset_ocelot_input_tar_file)
-        create_regression_csv_job.add_outputs(regression_OCELOT__ms_OCELOT_output_tar)
+        if self.featurize_shards == 1:
+            create_regression_csv_job = Job(transformation="create_regression_csv_transformation",
+                                            node_label="create_regression_csv_label")
+            self.workflow.add_jobs(create_regression_csv_job)
+            create_regression_csv_job.add_inputs(merged_dataset_ocelot_input_pack_file)
+            create_regression_csv_job.add_outputs(regression_OCELOT__ms_OCELOT_output_tar)
+        else:
+            #### one featurization job per shard on Bridges-2, then a merge job for the train/dev split
+            self.log.info(f"Featurizing the regression dataset in {self.featurize_shards} shards")
+            create_regression_csv_job = Job(transformation="merge_regression_csv_transformation",
+                                            node_label="merge_regression_csv_label")
+            create_regression_csv_job.add_args(str(self.featurize_shards))
+            create_regression_csv_job.add_selector_profile(execution_site=BRIDGES2_SITE_HANDLE)
+            self.workflow.add_jobs(create_regression_csv_job)
+            for shard_index in range(self.featurize_shards):
+                shard_output_tar = File(f"regression_OCELOT__ms_OCELOT__shard_{shard_index}.tgz")
+                create_regression_csv_shard_job = Job(transformation="create_regression_csv_shard_transformation",
+                                                      node_label=f"create_regression_csv_shard_{shard_index}_label")
+                create_regression_csv_shard_job.add_args(str(shard_index), str(self.featurize_shards),
+                                                         str(FEATURIZE_CPUS_PER_JOB))
+                create_regression_csv_shard_job.add_selector_profile(execution_site=BRIDGES2_SITE_HANDLE)
+                self.workflow.add_jobs(create_regression_csv_shard_job)
+                create_regression_csv_shard_job.add_inputs(merged_dataset_ocelot_input_pack_file)
+                create_regression_csv_shard_job.add_outputs(shard_output_tar)
+                create_regression_csv_job.add_inputs(shard_output_tar)
+            create_regression_csv_job.add_outputs(regression_OCELOT__ms_OCELOT_output_tar)
 
         ### run_regression.py
         run_regression_job = Job(transformation="run_regression_transformation", node_label="run_regression_label")
@@ -415,10 +585,12 @@ class CerebrasPyTorchWorkflow:
         run_inference_job.add_outputs(inference_MS_OCELOT_json_output_file)
 
         ## Job Dependencies
-        self.workflow.add_dependency(job=prepare_tokenization_split_job,
-                                     children=[create_csv_mlm_only_train_job,
-                                               create_csv_mlm_only_val_job,
-                                               create_csv_mlm_only_test_job, ])
+        if self.build_vocab:
+            self.workflow.add_dependency(job=prepare_tokenization_split_job, children=[build_vocab_job, ])
+            self.workflow.add_dependency(job=build_vocab_job, children=create_csv_mlm_only_jobs)
+        else:
+            self.workflow.add_dependency(job=prepare_tokenization_split_job,
+                                         children=create_csv_mlm_only_jobs)
         self.workflow.add_dependency(job=run_regression_job, parents=[create_regression_csv_job, run_roberta_job])
         self.workflow.add_dependency(job=run_inference_job, parents=[run_regression_job, ])
 
@@ -449,8 +621,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a sample multi-cluster Pegasus workflow at PSC")
     parser.add_argument('--project', dest='project', default=None, required=True,
                         help='Specifies the project/grantid of your project')
+    parser.add_argument('--featurize_shards', dest='featurize_shards', type=int, default=None,
+                        help='Number of jobs to split the regression featurization into; '
+                             'defaults to enough for each to take about {} minutes'.format(FEATURIZE_TARGET_RUNTIME // 60))
+    parser.add_argument('--featurize_timing_log', dest='featurize_timing_log', default=None,
+                        help='featurize_timing.tsv of an earlier create_regression_csv.py run, used to size '
+                             '--featurize_shards from the measured seconds per structure')
+    parser.add_argument('--single_csv_job', dest='single_csv_job', action='store_true',
+                        help='Generate the train, val and test CSVs in one job instead of three')
+    parser.add_argument('--build_vocab', dest='build_vocab', action='store_true',
+                        help='Derive a compact vocab from the train split before generating the CSVs '
+                             'and set vocab_size in the pretraining and regression params to match')
     args = parser.parse_args(sys.argv[1:])
-    wf = CerebrasPyTorchWorkflow(project=args.project)
+    wf = CerebrasPyTorchWorkflow(project=args.project, featurize_shards=args.featurize_shards,
+                                 single_csv_job=args.single_csv_job, build_vocab=args.build_vocab,
+                                 featurize_timing_log=args.featurize_timing_log)
     try:
         wf()
     except PegasusClientError as e: